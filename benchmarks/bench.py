@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""Measures ops/sec and allocations of ezmysql's sync and async modes.
+
+By default it runs against fake_server.FakeMySQLServer started in this
+process, so the numbers are the cost of ezmysql, pymysql and aiomysql
+rather than of a server; give --host to run against a real mysqld (it
+creates and drops the table `ezmysql_bench`).
+
+    python benchmarks/bench.py --output before.json
+    ... change something ...
+    python benchmarks/bench.py --compare before.json
+
+Every combination of --modes, --ops, --columns and --concurrency makes one
+entry of the JSON results: ops/sec from a timed run of --number calls,
+and from a second, serial run under tracemalloc the mean peak of memory
+allocated by one call (alloc_bytes_per_op) and what is still held after
+all of them (alloc_retained_bytes).
+
+The in-process server shares the GIL with the client threads, which
+weighs on the sync numbers at concurrency > 1. To leave it out, run
+`python benchmarks/fake_server.py --columns 16` in another shell and
+`python benchmarks/bench.py --host 127.0.0.1 --port 3307 --columns 16`.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ezmysql
+from ezmysql import ConnectionAsync, ConnectionSync
+from fake_server import FakeMySQLServer
+
+TABLE = 'ezmysql_bench'
+OPS = ('query', 'get', 'execute', 'table_insert', 'table_insert_many')
+
+
+def make_item(columns, width, i):
+    value = ('%0*d' % (width, i))[-width:]
+    return {'c%d' % c: value for c in range(columns)}
+
+
+def make_op(db, name, args):
+    '''Returns a function of i doing one call of op `name`, for
+    ConnectionAsync it returns the coroutine to await.'''
+    select = 'SELECT * FROM {} LIMIT %s'.format(TABLE)
+    get = 'SELECT * FROM {} WHERE id=%s LIMIT 1'.format(TABLE)
+    update = 'UPDATE {} SET c0=%s WHERE id=%s'.format(TABLE)
+    if name == 'query':
+        return lambda i: db.query(select, args.rows)
+    if name == 'get':
+        return lambda i: db.get(get, i)
+    if name == 'execute':
+        return lambda i: db.execute(update, 'v%d' % i, i)
+    item = make_item(args.current_columns, args.width, 0)
+    if name == 'table_insert':
+        return lambda i: db.table_insert(TABLE, item)
+    items = [make_item(args.current_columns, args.width, i)
+             for i in range(args.batch)]
+    return lambda i: db.table_insert_many(TABLE, items)
+
+
+def table_sql(columns, width):
+    fields = ','.join(['c%d VARCHAR(%d)' % (c, width)
+                       for c in range(columns)])
+    return ('CREATE TABLE IF NOT EXISTS {} (id INT AUTO_INCREMENT '
+            'PRIMARY KEY, {})').format(TABLE, fields)
+
+
+def setup_table(db_args, columns, args):
+    db = ConnectionSync(**db_args)
+    db.execute('DROP TABLE IF EXISTS ' + TABLE)
+    db.execute(table_sql(columns, args.width))
+    db.table_insert_many(TABLE, [make_item(columns, args.width, i)
+                                 for i in range(args.rows)])
+    db.close()
+
+
+def teardown_table(db_args):
+    db = ConnectionSync(**db_args)
+    db.execute('DROP TABLE IF EXISTS ' + TABLE)
+    db.close()
+
+
+def measure_allocations(run_one, count):
+    '''Returns (mean peak bytes of one call, bytes retained after all).'''
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        peaks = 0
+        for i in range(count):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            run_one(i)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+        retained = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return peaks // count, retained
+
+
+def bench_sync(db_args, name, concurrency, args):
+    if concurrency > 1:
+        db = ConnectionSync(pool_size=concurrency, **db_args)
+    else:
+        db = ConnectionSync(**db_args)
+    try:
+        op = make_op(db, name, args)
+        per_worker = max(args.number // concurrency, 1)
+
+        def run_workers(count):
+            def worker(w):
+                for i in range(count):
+                    op(w * count + i + 1)
+            if concurrency > 1:
+                with ThreadPoolExecutor(concurrency) as executor:
+                    list(executor.map(worker, range(concurrency)))
+            else:
+                worker(0)
+
+        # concurrent, to open all connections of the pool before timing
+        run_workers(args.warmup)
+        start = time.perf_counter()
+        run_workers(per_worker)
+        elapsed = time.perf_counter() - start
+        alloc = (None, None)
+        if args.alloc_number:
+            alloc = measure_allocations(lambda i: op(i + 1),
+                                        args.alloc_number)
+    finally:
+        db.close()
+    return per_worker * concurrency, elapsed, alloc
+
+
+async def _bench_async(db_args, name, concurrency, args):
+    db = ConnectionAsync(minsize=1, maxsize=concurrency, **db_args)
+    try:
+        op = make_op(db, name, args)
+        per_worker = max(args.number // concurrency, 1)
+
+        async def run_workers(count):
+            async def worker(w):
+                for i in range(count):
+                    await op(w * count + i + 1)
+            await asyncio.gather(*[worker(w) for w in range(concurrency)])
+
+        await run_workers(args.warmup)
+        start = time.perf_counter()
+        await run_workers(per_worker)
+        elapsed = time.perf_counter() - start
+        alloc = (None, None)
+        if args.alloc_number:
+            tracemalloc.start()
+            try:
+                base = tracemalloc.get_traced_memory()[0]
+                peaks = 0
+                for i in range(args.alloc_number):
+                    tracemalloc.reset_peak()
+                    current = tracemalloc.get_traced_memory()[0]
+                    await op(i + 1)
+                    peaks += tracemalloc.get_traced_memory()[1] - current
+                retained = tracemalloc.get_traced_memory()[0] - base
+            finally:
+                tracemalloc.stop()
+            alloc = (peaks // args.alloc_number, retained)
+    finally:
+        db.close()
+    return per_worker * concurrency, elapsed, alloc
+
+
+def bench_async(db_args, name, concurrency, args):
+    return asyncio.run(_bench_async(db_args, name, concurrency, args))
+
+
+def run(args):
+    server = None
+    if args.host:
+        db_args = {'host': args.host, 'port': args.port,
+                   'database': args.database, 'user': args.user,
+                   'password': args.password}
+    else:
+        server = FakeMySQLServer(rows=args.rows, width=args.width).start()
+        db_args = {'host': '127.0.0.1', 'port': server.port,
+                   'database': 'bench', 'user': 'bench', 'password': ''}
+    results = []
+    try:
+        for columns in args.columns:
+            args.current_columns = columns
+            if server is not None:
+                server.columns = columns
+            setup_table(db_args, columns, args)
+            for mode in args.modes:
+                bench = bench_sync if mode == 'sync' else bench_async
+                for name in args.ops:
+                    for concurrency in args.concurrency:
+                        ops, elapsed, alloc = bench(
+                            db_args, name, concurrency, args)
+                        result = {
+                            'mode': mode,
+                            'op': name,
+                            'columns': columns,
+                            'concurrency': concurrency,
+                            'ops': ops,
+                            'seconds': round(elapsed, 6),
+                            'ops_per_sec': round(ops / elapsed, 1),
+                            'alloc_bytes_per_op': alloc[0],
+                            'alloc_retained_bytes': alloc[1],
+                        }
+                        if name == 'table_insert_many':
+                            result['rows_per_sec'] = round(
+                                ops * args.batch / elapsed, 1)
+                        results.append(result)
+                        print_result(result)
+        if args.host:
+            teardown_table(db_args)
+    finally:
+        if server is not None:
+            server.stop()
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'ezmysql': ezmysql.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server': 'mysql' if args.host else 'fake',
+            'rows': args.rows,
+            'width': args.width,
+            'batch': args.batch,
+        },
+        'results': results,
+    }
+
+
+def result_key(result):
+    return (result['mode'], result['op'], result['columns'],
+            result['concurrency'])
+
+
+def print_result(result):
+    alloc = result['alloc_bytes_per_op']
+    print('{:5} {:17} cols={:<3} conc={:<3} {:>10.1f} ops/s  {:>10} B/op'
+          .format(result['mode'], result['op'], result['columns'],
+                  result['concurrency'], result['ops_per_sec'],
+                  '-' if alloc is None else alloc))
+
+
+def compare(baseline, current, threshold):
+    '''Prints the change of ops/sec from baseline, returns the number of
+    entries slower by more than threshold (0~1).'''
+    old = {result_key(r): r for r in baseline['results']}
+    regressions = 0
+    print('\ncompared with the baseline of', baseline['meta']['date'])
+    for result in current['results']:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result['ops_per_sec'] / before['ops_per_sec']
+        mark = ''
+        if ratio < 1 - threshold:
+            mark = '  REGRESSION'
+            regressions += 1
+        print('{:5} {:17} cols={:<3} conc={:<3} {:>+7.1%}{}'.format(
+            result['mode'], result['op'], result['columns'],
+            result['concurrency'], ratio - 1, mark))
+    return regressions
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+def str_list(s):
+    return s.split(',')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', type=str_list, default=['sync', 'async'])
+    parser.add_argument('--ops', type=str_list, default=list(OPS))
+    parser.add_argument('--columns', type=int_list, default=[4, 16, 64],
+                        help='row widths in columns, comma separated')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='calls timed for each entry')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='calls of every worker before timing')
+    parser.add_argument('--alloc-number', type=int, default=100,
+                        help='calls measured by tracemalloc, 0 to skip')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='rows returned by query()')
+    parser.add_argument('--width', type=int, default=16,
+                        help='bytes of every column value')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='rows of one table_insert_many() call')
+    parser.add_argument('--output', help='file to save the JSON results')
+    parser.add_argument('--compare', help='JSON results of a baseline run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression')
+    parser.add_argument('--host', help='a real MySQL server to use')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--database', default='test')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    args = parser.parse_args(argv)
+    for name in args.ops:
+        if name not in OPS:
+            parser.error('unknown op: {}'.format(name))
+    for mode in args.modes:
+        if mode not in ('sync', 'async'):
+            parser.error('unknown mode: {}'.format(mode))
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
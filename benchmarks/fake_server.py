@@ -0,0 +1,274 @@
+"""An in-process stand-in for a MySQL server, speaking just enough of the
+client/server protocol for pymysql and aiomysql to run query(), get(),
+execute() and the bulk writers against it, to measure ezmysql's own
+overhead without a real server.
+
+Every connection is accepted whatever the user and password. SELECTs get
+a result set of `rows` rows (or the LIMIT of the query) by `columns`
+VARCHAR columns of `width` bytes, other statements get an OK packet with
+an affected row count.
+"""
+
+import re
+import socket
+import socketserver
+import struct
+import threading
+
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_QUERY = 0x03
+COM_PING = 0x0e
+
+CLIENT_LONG_PASSWORD = 1
+CLIENT_FOUND_ROWS = 1 << 1
+CLIENT_LONG_FLAG = 1 << 2
+CLIENT_CONNECT_WITH_DB = 1 << 3
+CLIENT_LOCAL_FILES = 1 << 7
+CLIENT_PROTOCOL_41 = 1 << 9
+CLIENT_TRANSACTIONS = 1 << 13
+CLIENT_SECURE_CONNECTION = 1 << 15
+CLIENT_MULTI_STATEMENTS = 1 << 16
+CLIENT_MULTI_RESULTS = 1 << 17
+CLIENT_PLUGIN_AUTH = 1 << 19
+
+CAPABILITIES = (CLIENT_LONG_PASSWORD | CLIENT_FOUND_ROWS | CLIENT_LONG_FLAG |
+                CLIENT_CONNECT_WITH_DB | CLIENT_PROTOCOL_41 |
+                CLIENT_TRANSACTIONS | CLIENT_SECURE_CONNECTION |
+                CLIENT_MULTI_STATEMENTS | CLIENT_MULTI_RESULTS |
+                CLIENT_PLUGIN_AUTH)
+
+SERVER_STATUS_AUTOCOMMIT = 2
+VERSION = b'8.0.36-ezmysql-fake'
+UTF8MB4_GENERAL_CI = 45
+TYPE_LONGLONG = 8
+TYPE_VAR_STRING = 253
+MAX_PACKET = 0xffffff
+MAX_ALLOWED_PACKET = 64 << 20
+
+_RE_LIMIT = re.compile(rb'\blimit\s+(?:\d+\s*,\s*)?(\d+)\s*$', re.I)
+_RE_VARIABLE = re.compile(rb'^\s*select\s+@@(\w+)', re.I)
+
+
+def lenenc_int(n):
+    if n < 251:
+        return bytes((n,))
+    if n < 1 << 16:
+        return b'\xfc' + struct.pack('<H', n)
+    if n < 1 << 24:
+        return b'\xfd' + struct.pack('<I', n)[:3]
+    return b'\xfe' + struct.pack('<Q', n)
+
+
+def lenenc_str(b):
+    return lenenc_int(len(b)) + b
+
+
+def ok_packet(affected_rows=0, insert_id=0):
+    return (b'\x00' + lenenc_int(affected_rows) + lenenc_int(insert_id) +
+            struct.pack('<HH', SERVER_STATUS_AUTOCOMMIT, 0))
+
+
+def eof_packet():
+    return b'\xfe' + struct.pack('<HH', 0, SERVER_STATUS_AUTOCOMMIT)
+
+
+def err_packet(code, message):
+    return (b'\xff' + struct.pack('<H', code) + b'#HY000' +
+            message.encode('utf8'))
+
+
+def column_definition(name, type_code, length):
+    return (lenenc_str(b'def') + lenenc_str(b'bench') + lenenc_str(b't') +
+            lenenc_str(b't') + lenenc_str(name) + lenenc_str(name) +
+            b'\x0c' + struct.pack('<HIBHB', UTF8MB4_GENERAL_CI, length,
+                                  type_code, 0, 0) +
+            b'\x00\x00')
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = bytearray()
+        self._seq = 0
+
+    def _recv_exact(self, n):
+        buf = self._buf
+        while len(buf) < n:
+            data = self.request.recv(max(65536, n - len(buf)))
+            if not data:
+                raise EOFError
+            buf += data
+        data = bytes(buf[:n])
+        del buf[:n]
+        return data
+
+    def read_packet(self):
+        payload = b''
+        while True:
+            header = self._recv_exact(4)
+            length = int.from_bytes(header[:3], 'little')
+            self._seq = header[3] + 1
+            payload += self._recv_exact(length)
+            if length < MAX_PACKET:
+                return payload
+
+    def write_packets(self, payloads):
+        out = bytearray()
+        for payload in payloads:
+            while True:
+                part = payload[:MAX_PACKET]
+                payload = payload[MAX_PACKET:]
+                out += len(part).to_bytes(3, 'little')
+                out.append(self._seq & 0xff)
+                out += part
+                self._seq += 1
+                if len(part) < MAX_PACKET:
+                    break
+        self.request.sendall(out)
+
+    def handshake(self):
+        salt = b'12345678' + b'901234567890'
+        self._seq = 0
+        self.write_packets([
+            b'\x0a' + VERSION + b'\x00' +
+            struct.pack('<I', self.server.next_thread_id()) +
+            salt[:8] + b'\x00' +
+            struct.pack('<HBHH', CAPABILITIES & 0xffff, UTF8MB4_GENERAL_CI,
+                        SERVER_STATUS_AUTOCOMMIT, CAPABILITIES >> 16) +
+            bytes((len(salt) + 1,)) + b'\x00' * 10 + salt + b'\x00' +
+            b'mysql_native_password\x00'
+        ])
+        self.read_packet()
+        self.write_packets([ok_packet()])
+
+    def handle(self):
+        try:
+            self.handshake()
+            while True:
+                packet = self.read_packet()
+                command = packet[0]
+                if command == COM_QUIT:
+                    return
+                if command == COM_QUERY:
+                    self.write_packets(self.server.answer(packet[1:]))
+                elif command in (COM_PING, COM_INIT_DB):
+                    self.write_packets([ok_packet()])
+                else:
+                    self.write_packets([err_packet(
+                        1047, 'Unknown command %d' % command)])
+        except (EOFError, ConnectionError):
+            return
+
+
+class FakeMySQLServer(socketserver.ThreadingTCPServer):
+    '''Serves on 127.0.0.1 and a free port in a background thread:
+
+        with FakeMySQLServer(columns=8) as server:
+            db = ConnectionSync('127.0.0.1', 'bench', 'u', 'p',
+                                port=server.port)
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rows=1, columns=4, width=16, port=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.rows = rows
+        self.columns = columns
+        self.width = width
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._thread_id = 0
+        self._insert_id = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def next_thread_id(self):
+        with self._lock:
+            self._thread_id += 1
+            return self._thread_id
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def answer(self, sql):
+        '''Returns the packets answering a COM_QUERY.'''
+        self.queries += 1
+        sql = sql.strip().rstrip(b';')
+        verb = sql[:6].lower()
+        if verb == b'select' or verb.startswith(b'show'):
+            m = _RE_VARIABLE.match(sql)
+            if m:
+                value = MAX_ALLOWED_PACKET if (
+                    m.group(1).lower() == b'max_allowed_packet') else 0
+                return self.result_set([b'@@' + m.group(1)],
+                                       [[str(value).encode()]],
+                                       TYPE_LONGLONG)
+            m = _RE_LIMIT.search(sql)
+            rows = int(m.group(1)) if m else self.rows
+            return self.result_set(self._names(), self._rows(rows))
+        affected = 0
+        insert_id = 0
+        if verb in (b'insert', b'replac'):
+            # one row per "(...)" after VALUES
+            head, sep, values = sql.partition(b' VALUES ')
+            affected = values.count(b'),(') + 1 if sep else 1
+            with self._lock:
+                insert_id = self._insert_id + 1
+                self._insert_id += affected
+        elif verb in (b'update', b'delete'):
+            affected = 1
+        return [ok_packet(affected, insert_id)]
+
+    def _names(self):
+        return [b'c%d' % i for i in range(self.columns)]
+
+    def _rows(self, n):
+        value = b'x' * self.width
+        row = [value] * self.columns
+        return [row] * n
+
+    def result_set(self, names, rows, type_code=TYPE_VAR_STRING):
+        packets = [lenenc_int(len(names))]
+        packets.extend(column_definition(name, type_code, self.width * 4)
+                       for name in names)
+        packets.append(eof_packet())
+        for row in rows:
+            packets.append(b''.join([b'\xfb' if v is None else lenenc_str(v)
+                                     for v in row]))
+        packets.append(eof_packet())
+        return packets
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Runs the fake MySQL server in the foreground.')
+    parser.add_argument('--port', type=int, default=3307)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--columns', type=int, default=4)
+    parser.add_argument('--width', type=int, default=16)
+    args = parser.parse_args()
+    server = FakeMySQLServer(args.rows, args.columns, args.width, args.port)
+    print('fake MySQL server listening on 127.0.0.1:%s' % server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Measures the cold start of `import ezmysql` and of loading each
+connection class, in fresh interpreters, to keep short-lived jobs fast.
+
+    python benchmarks/import_time.py --output import.json
+    python benchmarks/import_time.py --max-ms 30    # exit 1 if slower
+
+Every statement runs --number times in a new `python -c`, timed inside the
+interpreter around the statement itself; the median and minimum in
+milliseconds are reported along with the drivers the statement loaded.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = [
+    'import ezmysql',
+    'from ezmysql import ConnectionSync',
+    'from ezmysql import ConnectionAsync',
+    'from ezmysql import ConnectionOracle',
+]
+
+DRIVERS = ('pymysql', 'aiomysql', 'asyncio', 'oracledb', 'numpy')
+
+_PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'ms': elapsed * 1000,
+                  'drivers': [m for m in {drivers!r} if m in sys.modules]}}))
+'''
+
+
+def run_once(statement):
+    code = _PROBE.format(statement=statement, drivers=DRIVERS)
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def measure(statement, number):
+    times = []
+    drivers = None
+    for _ in range(number):
+        try:
+            result = run_once(statement)
+        except subprocess.CalledProcessError as e:
+            # e.g. the driver of the class isn't installed here
+            error = e.stderr.decode().strip().splitlines()[-1]
+            return {'statement': statement, 'error': error}
+        times.append(result['ms'])
+        drivers = result['drivers']
+    return {
+        'statement': statement,
+        'median_ms': round(statistics.median(times), 3),
+        'min_ms': round(min(times), 3),
+        'drivers': drivers,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=10,
+                        help='fresh interpreters per statement')
+    parser.add_argument('--output', help='file to save the JSON results')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if the median of `import ezmysql` is '
+                             'slower')
+    args = parser.parse_args(argv)
+
+    results = []
+    for statement in STATEMENTS:
+        result = measure(statement, args.number)
+        results.append(result)
+        if 'error' in result:
+            print('{:40} {}'.format(statement, result['error']))
+        else:
+            print('{:40} {:>8.2f} ms  (min {:.2f})  loads: {}'.format(
+                statement, result['median_ms'], result['min_ms'],
+                ', '.join(result['drivers']) or '-'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {'python': platform.python_version(),
+                         'platform': platform.platform()},
+                'results': results,
+            }, f, indent=2)
+    if args.max_ms is not None and results[0]['median_ms'] > args.max_ms:
+        print('`import ezmysql` takes {} ms, more than {} ms'.format(
+            results[0]['median_ms'], args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
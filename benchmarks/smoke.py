@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Runs every method of ConnectionSync and ConnectionAsync once against
+fake_server.FakeMySQLServer, with and without an Instrumentation, to catch
+a broken code path without a real mysqld.
+
+    python benchmarks/smoke.py
+
+Prints one line per check and exits 1 if any of them fails.
+"""
+
+import asyncio
+import os
+import sys
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ezmysql import ConnectionAsync, ConnectionSync
+from ezmysql.instrument import Instrumentation
+from fake_server import FakeMySQLServer
+
+TABLE = 'ezmysql_smoke'
+SELECT = 'SELECT * FROM {} LIMIT %s'.format(TABLE)
+ITEMS = [{'c0': 'a%d' % i, 'c1': 'b%d' % i} for i in range(10)]
+
+
+def sync_checks(db):
+    yield 'query', lambda: len(db.query(SELECT, 5)) == 5
+    yield 'get', lambda: db.get(SELECT, 1) is not None
+    yield 'query_many', lambda: [len(r) for r in db.query_many(
+        [SELECT % 1, SELECT % 2])] == [1, 2]
+    yield 'query_iter', lambda: len(list(db.query_iter(
+        SELECT, 7, batch_size=3))) == 7
+    yield 'query_columns', lambda: len(db.query_columns(
+        SELECT, 6, use_numpy=False)['c0']) == 6
+    yield 'execute', lambda: db.execute(
+        'UPDATE {} SET c0=%s WHERE id=%s'.format(TABLE), 'x', 1) is not None
+    yield 'table_insert', lambda: db.table_insert(TABLE, ITEMS[0]) > 0
+    yield 'table_insert_many', lambda: sum(
+        db.table_insert_many(TABLE, ITEMS, max_rows=4)) == len(ITEMS)
+    yield 'table_upsert_many', lambda: sum(
+        db.table_upsert_many(TABLE, ITEMS, max_rows=4)) == len(ITEMS)
+
+    def transaction():
+        with db.transaction():
+            db.execute('UPDATE {} SET c0=%s WHERE id=%s'.format(TABLE),
+                       'y', 1)
+            return db.in_transaction()
+    yield 'transaction', transaction
+
+
+def async_checks(db):
+    async def query():
+        return len(await db.query(SELECT, 5)) == 5
+
+    async def get():
+        return await db.get(SELECT, 1) is not None
+
+    async def query_iter():
+        return len([r async for r in db.query_iter(
+            SELECT, 7, batch_size=3)]) == 7
+
+    async def stream():
+        return sum([len(b) async for b in db.stream(
+            SELECT, 7, batch_size=3)]) == 7
+
+    async def query_columns():
+        return len((await db.query_columns(
+            SELECT, 6, use_numpy=False))['c0']) == 6
+
+    async def table_insert_many():
+        return sum(await db.table_insert_many(
+            TABLE, ITEMS, max_rows=4)) == len(ITEMS)
+
+    async def writer():
+        async with db.writer(TABLE, max_rows=4) as w:
+            for item in ITEMS:
+                await w.add(item)
+        return w.rows_written == len(ITEMS)
+
+    async def transaction():
+        async with db.transaction():
+            await db.execute('UPDATE {} SET c0=%s WHERE id=%s'.format(TABLE),
+                             'y', 1)
+            return db.in_transaction()
+
+    async def transaction_iter():
+        # a statement during an open iteration raises instead of hanging
+        try:
+            async with db.transaction():
+                async for _ in db.query_iter(SELECT, 3):
+                    await db.execute(
+                        'UPDATE {} SET c0=%s WHERE id=%s'.format(TABLE),
+                        'z', 1)
+        except RuntimeError:
+            return not db.in_transaction()
+        return False
+
+    for check in (query, get, query_iter, stream, query_columns,
+                  table_insert_many, writer, transaction, transaction_iter):
+        yield check.__name__, check
+
+
+def report(name, ok, error=None):
+    print('{:40} {}'.format(name, 'ok' if ok else 'FAIL'))
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+    return ok
+
+
+def run_sync(port, instrument):
+    label = 'sync' if instrument is None else 'sync instrumented'
+    db = ConnectionSync('127.0.0.1', 'test', 'user', 'password', port=port,
+                        instrument=instrument)
+    passed = True
+    try:
+        for name, check in sync_checks(db):
+            try:
+                ok = check()
+            except Exception as e:
+                ok = report('{}: {}'.format(label, name), False, e)
+            else:
+                report('{}: {}'.format(label, name), ok)
+            passed = passed and ok
+    finally:
+        db.close()
+    return passed
+
+
+async def run_async(port, instrument):
+    label = 'async' if instrument is None else 'async instrumented'
+    db = ConnectionAsync('127.0.0.1', 'test', 'user', 'password', port=port,
+                         minsize=1, maxsize=2, instrument=instrument)
+    passed = True
+    try:
+        for name, check in async_checks(db):
+            try:
+                ok = await asyncio.wait_for(check(), 10)
+            except Exception as e:
+                ok = report('{}: {}'.format(label, name), False, e)
+            else:
+                report('{}: {}'.format(label, name), ok)
+            passed = passed and ok
+    finally:
+        db.close()
+    return passed
+
+
+def main():
+    passed = True
+    with FakeMySQLServer(rows=10, columns=2) as server:
+        for instrument in (None, Instrumentation()):
+            passed = run_sync(server.port, instrument) and passed
+            passed = asyncio.run(run_async(server.port, instrument)) and passed
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
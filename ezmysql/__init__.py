@@ -2,6 +2,37 @@
 
 __version__ = '0.10.1'
 
-from .connection_sync import ConnectionSync
-from .connection_async import ConnectionAsync
-from .connection_oracle import ConnectionOracle
+# The connection classes are imported on first use, so that
+# `import ezmysql` doesn't load pymysql, aiomysql, asyncio and oracledb
+# and a class works without the drivers of the others installed.
+_lazy_classes = {
+    'ConnectionSync': 'connection_sync',
+    'ConnectionAsync': 'connection_async',
+    'ConnectionOracle': 'connection_oracle',
+    'ConnectionOracleAsync': 'connection_oracle_async',
+    'ConnectionDM': 'connection_dm',
+    'RoutedConnectionSync': 'routing',
+    'RoutedConnectionAsync': 'routing',
+}
+
+# `from ezmysql import *` shouldn't need a driver ezmysql doesn't
+# install, the classes of oracledb and dmPython are imported by name
+_optional_classes = ('ConnectionOracle', 'ConnectionOracleAsync',
+                     'ConnectionDM')
+__all__ = ['__version__'] + [name for name in _lazy_classes
+                             if name not in _optional_classes]
+
+
+def __getattr__(name):
+    module = _lazy_classes.get(name)
+    if module is None:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    import importlib
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_classes))
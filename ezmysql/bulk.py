@@ -0,0 +1,209 @@
+"""Helpers to build chunked multi-row statements for bulk writing
+Only for python 3
+"""
+
+import datetime
+import itertools
+import os
+import tempfile
+
+# leave room for the packet header and the statement tail
+PACKET_MARGIN = 1024
+
+
+def item_rows(items, fields=None):
+    '''Returns (fields, rows) for a list or iterable of dict items.
+
+    fields: field names to write, default to the keys of the first item,
+    rows: an iterator of value tuples in the order of fields, missing
+    keys get None.
+    '''
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        return [], iter(())
+    if fields is None:
+        fields = list(first.keys())
+    else:
+        fields = list(fields)
+    rows = (tuple(item.get(f) for f in fields)
+            for item in itertools.chain((first,), items))
+    return fields, rows
+
+
+def chunks(rows, max_rows, max_bytes=0, sizeof=None):
+    '''Groups rows into lists of at most max_rows rows and, if sizeof is
+    given, at most max_bytes bytes as measured by sizeof(row).
+    A single row larger than max_bytes still makes a chunk of its own.
+    '''
+    chunk = []
+    size = 0
+    for row in rows:
+        if sizeof is not None:
+            n = sizeof(row)
+            if chunk and max_bytes and size + n > max_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+            size += n
+        chunk.append(row)
+        if len(chunk) >= max_rows:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def insert_prefix(table_name, fields, verb='INSERT'):
+    return '{} INTO {} ({}) VALUES '.format(
+        verb, table_name, ','.join(fields))
+
+
+def upsert_suffix(update_fields):
+    return ' ON DUPLICATE KEY UPDATE ' + ','.join(
+        ['{0}=VALUES({0})'.format(f) for f in update_fields])
+
+
+def upsert_statement(table_name, fields, update_fields=None, ignore=False):
+    '''Returns (prefix, suffix) of a multi-row upsert, INSERT IGNORE if
+    ignore, else INSERT ... ON DUPLICATE KEY UPDATE update_fields, which
+    default to all fields.'''
+    if ignore:
+        return insert_prefix(table_name, fields, 'INSERT IGNORE'), ''
+    return (insert_prefix(table_name, fields),
+            upsert_suffix(update_fields or fields))
+
+
+def multirow_statements(prefix, rows, literal,
+                        max_rows=1000, max_bytes=0, suffix=''):
+    '''Yields (sql, row_count) of multi-row statements like
+    `prefix (...),(...) suffix`.
+
+    literal: a function returns the escaped SQL literal of a row tuple,
+             e.g. pymysql's Connection.escape which gives "(1,'a')"
+    max_bytes: upper bound of the statement size in bytes,
+               usually the server's max_allowed_packet
+    '''
+    fixed = len(prefix.encode('utf8')) + len(suffix.encode('utf8'))
+    if max_bytes:
+        max_bytes = max(max_bytes - fixed - PACKET_MARGIN, 1)
+    literals = (literal(row) for row in rows)
+    # +1 for the comma between two rows
+    sizeof = lambda lit: len(lit.encode('utf8', 'surrogateescape')) + 1
+    for chunk in chunks(literals, max_rows, max_bytes, sizeof):
+        yield prefix + ','.join(chunk) + suffix, len(chunk)
+
+
+def update_many_statements(table_name, rows, key_field, literal,
+                           max_rows=1000, max_bytes=0):
+    '''Yields (sql, row count) of statements updating rows in groups:
+
+        UPDATE t SET a=CASE key WHEN 1 THEN 'x' WHEN 2 THEN 'y' ELSE a END
+        WHERE key IN (1,2)
+
+    rows: dicts of key_field and the fields to update, a field missing in
+          a row keeps its value
+    literal: a function returns the escaped SQL literal of a value
+    '''
+    def escaped(row):
+        key = literal(row[key_field])
+        values = {f: literal(v) for f, v in row.items() if f != key_field}
+        return key, values
+
+    def sizeof(entry):
+        key, values = entry
+        n = len(key.encode('utf8', 'surrogateescape'))
+        # " WHEN key THEN value" for every field, and "key," in the IN list
+        return sum(n + len(v.encode('utf8', 'surrogateescape')) + 12
+                   for v in values.values()) + n + 1
+
+    head = len('UPDATE {} SET  WHERE {} IN ()'.format(table_name, key_field))
+    if max_bytes:
+        max_bytes = max(max_bytes - head - PACKET_MARGIN, 1)
+    for chunk in chunks((escaped(row) for row in rows),
+                        max_rows, max_bytes, sizeof):
+        fields = []
+        for _, values in chunk:
+            for f in values:
+                if f not in fields:
+                    fields.append(f)
+        sets = []
+        for f in fields:
+            whens = ''.join([' WHEN {} THEN {}'.format(key, values[f])
+                             for key, values in chunk if f in values])
+            sets.append('{0}=CASE {1}{2} ELSE {0} END'.format(
+                f, key_field, whens))
+        keys = ','.join([key for key, _ in chunk])
+        sql = 'UPDATE {} SET {} WHERE {} IN ({})'.format(
+            table_name, ','.join(sets), key_field, keys)
+        yield sql, len(chunk)
+
+
+# =============== LOAD DATA LOCAL INFILE ===================
+
+def load_data_sql(table_name, fields, duplicates=None):
+    '''SQL of LOAD DATA LOCAL INFILE reading a file written by write_tsv(),
+    the file name is the %s parameter.
+
+    duplicates: None, 'ignore' or 'replace', how to handle rows duplicated
+                on a unique key
+    '''
+    modifier = ''
+    if duplicates:
+        assert duplicates in ('ignore', 'replace'), duplicates
+        modifier = duplicates.upper() + ' '
+    return ("LOAD DATA LOCAL INFILE %s {}INTO TABLE {} "
+            "CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' ({})").format(
+                modifier, table_name, ','.join(fields))
+
+
+def _tsv_field(v):
+    if v is None:
+        return b'\\N'
+    if isinstance(v, bytes):
+        b = v
+    elif isinstance(v, str):
+        b = v.encode('utf8')
+    elif isinstance(v, bool):
+        return b'1' if v else b'0'
+    elif isinstance(v, (int, float)):
+        return str(v).encode()
+    elif isinstance(v, datetime.datetime):
+        return v.isoformat(' ').encode()
+    elif isinstance(v, datetime.date):
+        return v.isoformat().encode()
+    else:
+        b = str(v).encode('utf8')
+    return (b.replace(b'\\', b'\\\\').replace(b'\t', b'\\t')
+            .replace(b'\n', b'\\n').replace(b'\r', b'\\r')
+            .replace(b'\0', b'\\0'))
+
+
+def write_tsv(f, rows):
+    '''Writes row tuples to a binary file in the tab-separated format of
+    load_data_sql(), returns the number of rows written.'''
+    n = 0
+    for row in rows:
+        f.write(b'\t'.join([_tsv_field(v) for v in row]))
+        f.write(b'\n')
+        n += 1
+    return n
+
+
+def write_tsv_file(rows):
+    '''Writes rows to a new temporary file, returns its name,
+    the caller removes it.'''
+    f = tempfile.NamedTemporaryFile(
+        'wb', prefix='ezmysql-', suffix='.tsv', delete=False)
+    try:
+        write_tsv(f, rows)
+    except BaseException:
+        f.close()
+        os.remove(f.name)
+        raise
+    f.close()
+    return f.name
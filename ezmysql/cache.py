@@ -0,0 +1,289 @@
+"""Caches of ezmysql
+Only for python 3
+"""
+
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class LRUCache:
+    '''A thread-safe dict keeps at most maxsize keys, the least recently
+    used key is evicted first.'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# =============== SQL templates of the table_* methods ===================
+
+# (table_name, fields, operation, paramstyle) -> SQL with placeholders
+sql_templates = LRUCache(maxsize=1024)
+
+
+def placeholders(n, paramstyle='format'):
+    '''n placeholders in a DB-API paramstyle: 'format' (%s) of pymysql,
+    'numeric' (:1, :2...) of oracledb or 'qmark' (?) of dmPython'''
+    if paramstyle == 'numeric':
+        return [':{}'.format(i) for i in range(1, n + 1)]
+    if paramstyle == 'qmark':
+        return ['?'] * n
+    return ['%s'] * n
+
+
+def _template(op, table_name, fields, build, paramstyle='format'):
+    key = (table_name, fields, op, paramstyle)
+    sql = sql_templates.get(key)
+    if sql is None:
+        sql = build(table_name, fields, paramstyle)
+        sql_templates.put(key, sql)
+    return sql
+
+
+def _build_insert(table_name, fields, paramstyle):
+    return 'INSERT INTO {} ({}) VALUES({})'.format(
+        table_name, ','.join(fields),
+        ','.join(placeholders(len(fields), paramstyle)))
+
+
+def _build_update(table_name, fields, paramstyle):
+    fields, field_where = fields
+    marks = placeholders(len(fields) + 1, paramstyle)
+    upsets = ','.join(['{}={}'.format(k, m) for k, m in zip(fields, marks)])
+    return 'UPDATE {} SET {} WHERE {}={}'.format(
+        table_name, upsets, field_where, marks[-1])
+
+
+def _build_has(table_name, field, paramstyle):
+    mark = placeholders(1, paramstyle)[0]
+    if paramstyle == 'numeric':
+        # Oracle has no LIMIT
+        return 'SELECT {0} FROM {1} WHERE {0}={2} AND ROWNUM=1'.format(
+            field, table_name, mark)
+    return 'SELECT {} FROM {} WHERE {}={} limit 1'.format(
+        field, table_name, field, mark)
+
+
+def insert_sql(table_name, fields, paramstyle='format'):
+    '''fields: tuple of field names'''
+    return _template('insert', table_name, fields, _build_insert, paramstyle)
+
+
+def update_sql(table_name, fields, field_where, paramstyle='format'):
+    '''fields: tuple of field names to update'''
+    return _template('update', table_name, (fields, field_where),
+                     _build_update, paramstyle)
+
+
+def has_sql(table_name, field, paramstyle='format'):
+    return _template('has', table_name, field, _build_has, paramstyle)
+
+
+# =============== query result cache ===================
+
+# a table or a comma-separated list of them, with aliases
+_TABLE_LIST = r'((?:[`\w.]+(?:\s+(?:AS\s+)?\w+)?\s*,\s*)*[`\w.]+)'
+_RE_READ_TABLES = re.compile(
+    r'\b(?:FROM|JOIN|STRAIGHT_JOIN)\s+' + _TABLE_LIST, re.I)
+_RE_WRITE_TABLES = re.compile(
+    r'\b(?:INTO(?:\s+TABLE)?|UPDATE|FROM|JOIN|STRAIGHT_JOIN|TABLE|USING)'
+    r'\s+(?:IGNORE\s+|LOW_PRIORITY\s+)*' + _TABLE_LIST, re.I)
+_RE_NOT_CACHED = re.compile(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\b', re.I)
+_RE_ALIAS = re.compile(r'\s+(?:AS\s+)?\w+$', re.I)
+
+# sql -> (tables read, tables written)
+_sql_tables = LRUCache(maxsize=4096)
+
+
+def _table_name(name):
+    # `db`.`tbl` -> tbl
+    return name.replace('`', '').split('.')[-1].lower()
+
+
+def _list_tables(groups):
+    tables = set()
+    for group in groups:
+        for name in group.split(','):
+            tables.add(_table_name(_RE_ALIAS.sub('', name.strip())))
+    return tables
+
+
+def sql_tables(sql):
+    '''Returns (tables read, tables written) by the SQL as frozensets,
+    tables read is None if its result should not be cached,
+    tables written is None if they can not be told.'''
+    tables = _sql_tables.get(sql)
+    if tables is not None:
+        return tables
+    words = sql.lstrip(' \t\r\n(').split(None, 1)
+    verb = words[0].upper() if words else ''
+    if verb == 'SELECT':
+        read = set()
+        if not _RE_NOT_CACHED.search(sql):
+            read = _list_tables(_RE_READ_TABLES.findall(sql))
+        tables = (frozenset(read) or None, frozenset())
+    elif verb in ('SHOW', 'DESC', 'DESCRIBE', 'EXPLAIN', 'USE', 'SET'):
+        tables = (None, frozenset())
+    else:
+        # `UPDATE a, b SET ...`, `DELETE FROM a, b USING ...` write all
+        written = _list_tables(_RE_WRITE_TABLES.findall(sql))
+        tables = (None, frozenset(written) or None)
+    if len(sql) <= 2048:
+        # don't keep big statements with inlined values alive
+        _sql_tables.put(sql, tables)
+    return tables
+
+
+def _row_size(row):
+    size = sys.getsizeof(row)
+    if row is not None:
+        for v in (row.values() if isinstance(row, Mapping) else row):
+            size += sys.getsizeof(v)
+    return size
+
+
+def _sizeof(value, many):
+    '''rough memory size of a row, or a list of rows if many'''
+    if not many:
+        return _row_size(value)
+    return sys.getsizeof(value) + sum(_row_size(row) for row in value)
+
+
+class ResultCache:
+    '''Read-through cache of query()/get() results, keyed by
+    (method, sql, parameters).
+
+    ttl: seconds an entry lives
+    max_bytes: upper bound of the (estimated) memory of all entries,
+               the least recently used ones are evicted beyond it
+
+    Every entry is tagged with the tables its SELECT reads, writes to
+    these tables through the connection holding the cache invalidate
+    them. Writes by others are only seen after ttl. Cached rows are
+    shared by callers, don't modify them.
+
+        cache = ResultCache(ttl=30)
+        db = ConnectionSync(host, database, user, password,
+                            result_cache=cache)
+        ...
+        print(cache.stats())
+    '''
+    def __init__(self, ttl=60, max_bytes=64*1024*1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # key -> (expire_time, size, tables, value)
+        self._data = OrderedDict()
+        # table -> set of keys
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def key(self, method, sql, args):
+        '''Returns the key of a read, None if it is not cacheable.'''
+        if sql_tables(sql)[0] is None:
+            return None
+        if isinstance(args, dict):
+            args = tuple(sorted(args.items()))
+        key = (method, sql, args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        '''Returns (hit, value).'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[3]
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        size = _sizeof(value, key[0] == 'query')
+        if size > self.max_bytes:
+            return
+        tables = sql_tables(key[1])[0]
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + self.ttl, size, tables, value)
+            self.bytes += size
+            for table in tables:
+                self._tags.setdefault(table, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        _, size, tables, _ = self._data.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self._tags.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[table]
+
+    def invalidate(self, tables=None):
+        '''Drops entries reading any of tables, all entries if None.'''
+        with self._lock:
+            if tables is None:
+                self._data.clear()
+                self._tags.clear()
+                self.bytes = 0
+                return
+            for table in tables:
+                for key in list(self._tags.get(_table_name(table), ())):
+                    self._remove(key)
+
+    def invalidate_sql(self, sql):
+        '''Drops entries of the tables the SQL writes to.'''
+        written = sql_tables(sql)[1]
+        if written is None or written:
+            self.invalidate(written)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'entries': len(self._data),
+            'bytes': self.bytes,
+        }
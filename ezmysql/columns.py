@@ -0,0 +1,131 @@
+"""Columnar results: {column: array} instead of a list of rows
+Only for python 3
+"""
+
+# kinds of column by MySQL field type, see pymysql.constants.FIELD_TYPE,
+# not BIT as pymysql returns it as bytes
+_MYSQL_KINDS = {
+    1: 'int',  # TINY
+    2: 'int',  # SHORT
+    3: 'int',  # LONG
+    8: 'int',  # LONGLONG
+    9: 'int',  # INT24
+    13: 'int',  # YEAR
+    4: 'float',  # FLOAT
+    5: 'float',  # DOUBLE
+    0: 'float',  # DECIMAL
+    246: 'float',  # NEWDECIMAL
+    7: 'datetime',  # TIMESTAMP
+    12: 'datetime',  # DATETIME
+    10: 'date',  # DATE
+    14: 'date',  # NEWDATE
+}
+
+_ORACLE_KINDS = {
+    'DB_TYPE_BINARY_INTEGER': 'int',
+    'DB_TYPE_BINARY_FLOAT': 'float',
+    'DB_TYPE_BINARY_DOUBLE': 'float',
+    'DB_TYPE_DATE': 'datetime',
+    'DB_TYPE_TIMESTAMP': 'datetime',
+}
+
+_DTYPES = {
+    'datetime': 'datetime64[us]',
+    'date': 'datetime64[D]',
+}
+
+
+def mysql_kinds(description):
+    return [_MYSQL_KINDS.get(d[1]) for d in description]
+
+
+def oracle_kinds(description):
+    kinds = []
+    for d in description:
+        name = getattr(d[1], 'name', '')
+        if name == 'DB_TYPE_NUMBER':
+            # NUMBER(p, 0) holds integers
+            kinds.append('int' if d[5] == 0 and d[4] else 'float')
+        else:
+            kinds.append(_ORACLE_KINDS.get(name))
+    return kinds
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def to_array(values, kind, np):
+    '''Converts a list of a column to a numpy array by its kind,
+    NULL is NaN for numbers and NaT for time, other kinds stay lists,
+    as does a column with values numpy can't take (like the zero date
+    '0000-00-00' returned as a string).'''
+    if np is None or kind is None:
+        return values
+    try:
+        return _to_array(values, kind, np)
+    except (ValueError, TypeError, OverflowError):
+        return values
+
+
+def _to_array(values, kind, np):
+    if kind == 'int':
+        if None not in values:
+            try:
+                return np.array(values, dtype=np.int64)
+            except OverflowError:
+                # BIGINT UNSIGNED
+                return np.array(values, dtype=np.uint64)
+        kind = 'float'
+    if kind == 'float':
+        nan = float('nan')
+        return np.array([nan if v is None else v for v in values],
+                        dtype=np.float64)
+    return np.array(values, dtype=_DTYPES[kind])
+
+
+def unique_names(names, tables=None):
+    '''Returns the column names with the repeated ones made unique.'''
+    unique = []
+    seen = set()
+    for i, name in enumerate(names):
+        if name in seen and tables is not None and tables[i]:
+            name = tables[i] + '.' + name
+        base, n = name, 1
+        while name in seen:
+            n += 1
+            name = '{}_{}'.format(base, n)
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+
+class ColumnCollector:
+    '''Collects batches of tuple rows into one list per column, and turns
+    them into numpy arrays at the end if numpy is installed.
+
+    A repeated column name, like `id` of both sides of a JOIN, is prefixed
+    with its table name as row_index() does, or given a `_2`, `_3` suffix
+    when the tables are unknown, so no column overwrites another.'''
+    def __init__(self, description, kinds, tables=None):
+        self.names = unique_names([d[0] for d in description], tables)
+        self.kinds = kinds
+        self._columns = [[] for _ in self.names]
+
+    def add(self, rows):
+        if not rows:
+            return
+        for column, values in zip(self._columns, zip(*rows)):
+            column.extend(values)
+
+    def result(self, use_numpy=True):
+        np = _numpy() if use_numpy else None
+        columns = {}
+        for name, kind, values in zip(self.names, self.kinds, self._columns):
+            columns[name] = to_array(values, kind, np)
+        self._columns = None
+        return columns
@@ -3,21 +3,84 @@ Only for Python 3
 """
 
 import asyncio
+import contextlib
+import contextvars
+import os
+import time
 import traceback
 import aiomysql
 import pymysql
 
+from . import bulk
+from . import cache
+from . import columns
+from . import membership
+from .errors import is_connection_error
+from .instrument import NO_EVENT
+from .row import Row, row_index
+from .transaction import GroupCommit, Pinned
+
+
+class RowCursorMixin:
+    """Makes rows of the cursor compact Row objects"""
+    async def _do_get_result(self):
+        await super()._do_get_result()
+        self._index = None
+        if self._description:
+            fields = self._result.fields
+            self._index = row_index([f.name for f in fields],
+                                    [f.table_name for f in fields])
+        if self._index and self._rows:
+            self._rows = [self._conv_row(r) for r in self._rows]
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        return Row(super()._conv_row(row), self._index)
+
+
+class RowCursor(RowCursorMixin, aiomysql.cursors.Cursor):
+    """A cursor which returns results as Row"""
+
+
+class SSRowCursor(RowCursorMixin, aiomysql.cursors.SSCursor):
+    """An unbuffered cursor which returns results as Row"""
+
+
+# end of the batches of ConnectionAsync.stream()
+_STREAM_END = object()
+
+
+class _StreamError:
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
 
 class ConnectionAsync:
     def __init__(self, host, database, user, password,
                  loop=None,
                  minsize=3, maxsize=5,
                  return_dict=True,
+                 compact_rows=False,
                  pool_recycle=7*3600,
                  autocommit=True,
                  charset="utf8mb4",
+                 result_cache=None,
+                 instrument=None,
+                 keepalive=None,
                  **kwargs):
         '''
+        compact_rows: return rows as row.Row, a tuple with a shared column
+                      index, which reads like a dict but costs less memory
+        result_cache: a cache.ResultCache to cache results of query() and
+                      get(), invalidated by writes through this object
+        instrument: an instrument.Instrumentation to time every statement
+                    and the wait for a pool connection
+        keepalive: seconds between pings of the idle connections by a
+                   background task, which closes the dead ones and opens
+                   new ones up to minsize, so requests don't find them
         kwargs: all parameters that aiomysql.connect() accept.
         '''
         self.db_args = {
@@ -32,16 +95,32 @@ class ConnectionAsync:
             'autocommit': autocommit,
             'pool_recycle': pool_recycle,
         }
+        # unbuffered cursor for query_iter()
+        self._ss_cursorclass = aiomysql.cursors.SSCursor
         if return_dict:
             self.db_args['cursorclass'] = aiomysql.cursors.DictCursor
+            self._ss_cursorclass = aiomysql.cursors.SSDictCursor
+        if compact_rows:
+            self.db_args['cursorclass'] = RowCursor
+            self._ss_cursorclass = SSRowCursor
         if kwargs:
             self.db_args.update(kwargs)
         self.pool = None
+        self._max_packet = None
+        self.result_cache = result_cache
+        self.instrument = instrument
+        self.keepalive = keepalive
+        self._keepalive_task = None
+        self._pin_var = contextvars.ContextVar('ezmysql_pinned',
+                                               default=None)
 
     def __del__(self):
         self.close()
 
     def close(self):
+        if getattr(self, '_keepalive_task', None) is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
         if self.pool is not None:
             self.pool.terminate()
             self.pool = None
@@ -50,86 +129,559 @@ class ConnectionAsync:
         if not self.db_args['loop']:
             self.db_args['loop'] = asyncio.get_running_loop()
         self.pool = await aiomysql.create_pool(**self.db_args)
+        if self.keepalive and self._keepalive_task is None:
+            self._keepalive_task = asyncio.get_running_loop().create_task(
+                self._keep_alive())
 
-    async def query_many(self, queries):
-        """query many SQLs, Returns all result."""
+    async def warm_up(self):
+        """Creates the pool with its minsize connections now rather than
+        in the first request, returns the number of connections open.
+        Call it at startup."""
         if not self.pool:
             await self.init_pool()
-        async with self.pool.acquire() as conn:
+        return self.pool.size
+
+    async def ping_idle(self):
+        """Pings the idle connections of the pool one by one and closes
+        those that fail, the pool replaces them up to minsize."""
+        pool = self.pool
+        if pool is None:
+            return
+        # the pool hands out idle connections oldest first, and drops
+        # the ones already closed by the server on its own
+        for _ in range(pool.freesize):
+            if self.pool is not pool or not pool.freesize:
+                return
+            conn = await pool.acquire()
+            try:
+                await conn.ping(False)
+            except Exception:
+                conn.close()
+            finally:
+                await pool.release(conn)
+        if self.pool is pool and pool.size < pool.minsize:
+            # an acquire opens connections up to minsize
+            conn = await pool.acquire()
+            await pool.release(conn)
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            try:
+                await self.ping_idle()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    async def _pool_acquire(self):
+        if not self.pool:
+            await self.init_pool()
+        if self.instrument is None:
+            return await self.pool.acquire()
+        start = time.perf_counter()
+        conn = await self.pool.acquire()
+        self.instrument.record_pool_wait(time.perf_counter() - start)
+        return conn
+
+    @contextlib.asynccontextmanager
+    async def _acquire(self, reading=False):
+        """Acquires a connection of the pool, creating the pool first
+        if needed, or the connection of the transaction the task is in.
+
+        reading: the caller reads a result from a server-side cursor in
+                 between its yields, the connection of a transaction
+                 can't run another statement until it ends
+        """
+        pinned = self._pinned()
+        if pinned is not None:
+            # tasks started in the transaction share it one at a time
+            async with pinned.lock:
+                if pinned.reading:
+                    # nobody holds the lock to wait for, the reader is
+                    # in the caller's hands
+                    raise RuntimeError(
+                        'the connection of the transaction is still '
+                        'reading a query_iter() or stream(), finish or '
+                        'aclose() it before the next statement')
+                if not reading:
+                    yield pinned.conn
+                    return
+                pinned.reading = True
+            try:
+                yield pinned.conn
+            finally:
+                pinned.reading = False
+            return
+        conn = await self._pool_acquire()
+        pool = self.pool
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    def _pinned(self):
+        pinned = self._pin_var.get()
+        if pinned is None or pinned.closed:
+            return None
+        return pinned
+
+    def in_transaction(self):
+        """Whether this task is in a transaction() or group_commit()."""
+        return self._pinned() is not None
+
+    def transaction(self):
+        """Runs the statements of the block in one transaction on one
+        pool connection, committed when the block ends, rolled back if
+        it raises:
+
+            async with db.transaction():
+                await db.execute('UPDATE account SET n=n-1 WHERE id=%s', 1)
+                await db.execute('UPDATE account SET n=n+1 WHERE id=%s', 2)
+
+        The connection is pinned to the task (the context) for the whole
+        block, tasks started in it share the connection one statement at
+        a time. A transaction() or group_commit() in the block is part of
+        this one.
+        """
+        return self._pin(None)
+
+    def group_commit(self, max_statements=100, max_delay=0.05):
+        """Like transaction(), but commits every max_statements writes, or
+        when a write comes max_delay seconds after the oldest one not
+        committed, as ConnectionSync.group_commit() does.
+        """
+        return self._pin(GroupCommit(max_statements, max_delay))
+
+    @contextlib.asynccontextmanager
+    async def _pin(self, group):
+        if self._pinned() is not None:
+            yield self
+            return
+        conn = await self._pool_acquire()
+        pool = self.pool
+        pinned = Pinned(conn, group, asyncio.Lock())
+        token = self._pin_var.set(pinned)
+        try:
+            await conn.begin()
+            yield self
+            # a `break` leaves an iteration open until it is finalized,
+            # its connection can't commit in the middle of a result
+            await self._close_readers(pinned)
+            # the lock of the tasks sharing it
+            async with self._acquire():
+                await self._commit(pinned)
+        except BaseException:
+            try:
+                await self._close_readers(pinned)
+                async with self._acquire():
+                    await conn.rollback()
+            except Exception:
+                # the pool drops a closed connection, the server rolls
+                # back what it had
+                conn.close()
+            raise
+        finally:
+            pinned.closed = True
+            self._pin_var.reset(token)
+            await pool.release(conn)
+
+    async def _close_readers(self, pinned):
+        readers = pinned.readers
+        pinned.readers = []
+        for gen in readers:
+            await gen.aclose()
+
+    async def _commit(self, pinned):
+        await pinned.conn.commit()
+        if self.result_cache is not None:
+            for query in pinned.written:
+                self.result_cache.invalidate_sql(query)
+        pinned.written = []
+
+    async def _written(self, conn):
+        """Counts a write of a group_commit(), committing the group when
+        it is due. Call it holding the connection."""
+        pinned = self._pinned()
+        if (pinned is not None and pinned.conn is conn and
+                pinned.group is not None and pinned.group.add()):
+            await self._commit(pinned)
+            pinned.group.committed()
+            await conn.begin()
+
+    def _event(self, method, query, args=None):
+        if self.instrument is None:
+            return NO_EVENT
+        return self.instrument.event(method, query, args)
+
+    async def query_many(self, queries, parallel=False,
+                         return_exceptions=False):
+        """query many SQLs, Returns all result.
+
+        parallel: run the queries at the same time, each on its own pool
+                  connection, results keep the order of queries
+        return_exceptions: put the exception of a failed query in its place
+                           of the results instead of raising it
+        """
+        if not self.pool:
+            await self.init_pool()
+        if parallel:
+            results = await asyncio.gather(
+                *[self.query(q) for q in queries],
+                return_exceptions=return_exceptions)
+            return list(results)
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 results = []
                 for query in queries:
                     try:
-                        await cur.execute(query)
-                        ret = await cur.fetchall()
-                    except pymysql.err.InternalError:
-                        await conn.ping()
-                        await cur.execute(query)
-                        ret = await cur.fetchall()
+                        with self._event('query_many', query) as ev:
+                            try:
+                                await cur.execute(query)
+                                ret = await cur.fetchall()
+                            except pymysql.err.InternalError:
+                                await conn.ping()
+                                await cur.execute(query)
+                                ret = await cur.fetchall()
+                            ev.rows = len(ret)
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        ret = e
                     results.append(ret)
                 return results
 
+    def _cache_key(self, method, query, args):
+        if self.result_cache is None:
+            return None
+        if self._pinned() is not None:
+            # a transaction sees its own writes, not for the others
+            return None
+        return self.result_cache.key(method, query, args)
+
+    def _invalidate(self, query):
+        if self.result_cache is not None:
+            self.result_cache.invalidate_sql(query)
+            pinned = self._pinned()
+            if pinned is not None:
+                pinned.written.append(query)
+
     async def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
-        if not self.pool:
-            await self.init_pool()
-        async with self.pool.acquire() as conn:
+        args = kwparameters or parameters
+        key = self._cache_key('query', query, args)
+        if key is not None:
+            hit, ret = self.result_cache.get(key)
+            if hit:
+                return ret[:]
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
+                with self._event('query', query, args) as ev:
+                    try:
+                        await cur.execute(query, args)
+                        ret = await cur.fetchall()
+                    except pymysql.err.InternalError:
+                        await conn.ping()
+                        await cur.execute(query, args)
+                        ret = await cur.fetchall()
+                    ev.rows = len(ret)
+        if key is not None:
+            self.result_cache.put(key, ret)
+            ret = ret[:]
+        return ret
+
+    def query_iter(self, query, *parameters, batch_size=1000,
+                   **kwparameters):
+        """Async generator yields rows of the given query one by one,
+        fetching them from a server-side cursor `batch_size` rows at a time.
+
+            async for row in db.query_iter(sql):
+                ...
+
+        In a transaction() the connection is busy until the iteration
+        ends, another statement on it meanwhile raises RuntimeError. An
+        iteration left open is closed before the transaction commits.
+        """
+        args = kwparameters or parameters
+        return self._reader(self._query_iter(query, args, batch_size))
+
+    def _reader(self, gen):
+        """Registers the async generator of query_iter() or stream() with
+        the transaction of the task, which closes it before committing."""
+        pinned = self._pinned()
+        if pinned is not None:
+            # forget the ones already finished
+            pinned.readers = [g for g in pinned.readers
+                              if g.ag_frame is not None]
+            pinned.readers.append(gen)
+        return gen
+
+    async def _query_iter(self, query, args, batch_size):
+        async with self._acquire(reading=True) as conn:
+            async with conn.cursor(self._ss_cursorclass) as cur:
+                with self._event('query_iter', query, args):
+                    try:
+                        await cur.execute(query, args)
+                    except pymysql.err.InternalError:
+                        if self._pinned() is not None:
+                            # a reconnect would lose the transaction
+                            raise
+                        await conn.ping()
+                        await cur.execute(query, args)
+                while True:
+                    with self._event('fetch', query) as ev:
+                        rows = await cur.fetchmany(batch_size)
+                        ev.rows = len(rows)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+
+    def stream(self, query, *parameters, batch_size=1000, prefetch=2,
+               **kwparameters):
+        """Async generator yields the rows of the given query in lists of
+        up to `batch_size` rows, read from a server-side cursor by a
+        background task at most `prefetch` batches ahead of the consumer,
+        so that a slow consumer slows the reading down instead of piling
+        the result up in memory.
+
+            async for batch in db.stream(sql, batch_size=5000):
+                ...
+
+        The pool connection is held until the end. Leaving the loop early
+        or being cancelled closes it, as the rest of the result is still
+        on its way; after a `break` that happens when the generator is
+        finalized, use contextlib.aclosing(db.stream(...)) to make it at
+        once. In a transaction() the connection is kept, the rest of the
+        result is read and dropped instead, at the latest before the
+        transaction commits.
+        """
+        args = kwparameters or parameters
+        return self._reader(self._stream(query, args, batch_size, prefetch))
+
+    async def _stream(self, query, args, batch_size, prefetch):
+        queue = asyncio.Queue(maxsize=max(prefetch, 1))
+        async with self._acquire(reading=True) as conn:
+            pinned = self._pinned()
+            # closing the connection would end the transaction with it
+            keep = pinned is not None and pinned.conn is conn
+            cur = await conn.cursor(self._ss_cursorclass)
+            producer = asyncio.ensure_future(self._stream_batches(
+                conn, cur, query, args, batch_size, queue))
+            finished = False
+            try:
+                while True:
+                    batch = await self._next_batch(queue, producer)
+                    if batch is None:
+                        # the producer is gone without a word, cancelled
+                        # from outside: raises its CancelledError
+                        producer.result()
+                        break
+                    if batch is _STREAM_END:
+                        finished = True
+                        break
+                    if isinstance(batch, _StreamError):
+                        finished = True
+                        raise batch.error
+                    yield batch
+            finally:
+                if not finished and keep:
+                    # a cancelled read leaves the protocol in the middle
+                    # of a packet, let the producer read to the end
+                    finished = await self._drain_stream(queue, producer)
+                if not producer.done():
+                    producer.cancel()
+                if finished:
+                    await cur.close()
+                else:
+                    conn.close()
+                await asyncio.wait([producer])
+
+    async def _next_batch(self, queue, producer):
+        """Returns the next batch of a stream(), _STREAM_END or a
+        _StreamError, None if the producer ended without putting one."""
+        while True:
+            if not queue.empty():
+                return queue.get_nowait()
+            if producer.done():
+                return None
+            getter = asyncio.ensure_future(queue.get())
+            try:
+                await asyncio.wait({getter, producer},
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            if getter.done() and not getter.cancelled():
+                return getter.result()
+
+    async def _drain_stream(self, queue, producer):
+        """Drops the batches left of a stream(), returns whether the
+        result was read to its end."""
+        while True:
+            batch = await self._next_batch(queue, producer)
+            if batch is _STREAM_END:
+                return True
+            if batch is None or isinstance(batch, _StreamError):
+                return False
+
+    async def _stream_batches(self, conn, cur, query, args, batch_size,
+                              queue):
+        try:
+            with self._event('stream', query, args):
                 try:
-                    await cur.execute(query, kwparameters or parameters)
-                    ret = await cur.fetchall()
+                    await cur.execute(query, args)
                 except pymysql.err.InternalError:
+                    if self._pinned() is not None:
+                        # a reconnect would lose the transaction
+                        raise
                     await conn.ping()
-                    await cur.execute(query, kwparameters or parameters)
-                    ret = await cur.fetchall()
-                return ret
+                    await cur.execute(query, args)
+            while True:
+                with self._event('fetch', query) as ev:
+                    rows = await cur.fetchmany(batch_size)
+                    ev.rows = len(rows)
+                if not rows:
+                    break
+                await queue.put(rows)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(_StreamError(e))
+            return
+        await queue.put(_STREAM_END)
+
+    async def query_columns(self, query, *parameters, batch_size=10000,
+                            use_numpy=True, **kwparameters):
+        """Returns {column: values} for the given query, rows are fetched
+        from a server-side cursor `batch_size` at a time into one list per
+        column. With numpy installed and use_numpy, integer, float, decimal
+        and date/time columns are numpy arrays (NULL as NaN or NaT, decimal
+        as float64), other columns stay lists.
+        """
+        args = kwparameters or parameters
+        async with self._acquire() as conn:
+            async with conn.cursor(aiomysql.cursors.SSCursor) as cur:
+                with self._event('query_columns', query, args) as ev:
+                    try:
+                        await cur.execute(query, args)
+                    except pymysql.err.InternalError:
+                        await conn.ping()
+                        await cur.execute(query, args)
+                    collector = columns.ColumnCollector(
+                        cur.description, columns.mysql_kinds(cur.description),
+                        [f.table_name for f in cur._result.fields])
+                    n = 0
+                    while True:
+                        rows = await cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        n += len(rows)
+                        collector.add(rows)
+                    ev.rows = n
+        return collector.result(use_numpy)
 
     async def get(self, query, *parameters, **kwparameters):
         """Returns the (singular) row returned by the given query.
         """
-        if not self.pool:
-            await self.init_pool()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute(query, kwparameters or parameters)
-                    ret = await cur.fetchone()
-                except pymysql.err.InternalError:
-                    await conn.ping()
-                    await cur.execute(query, kwparameters or parameters)
-                    ret = await cur.fetchone()
+        args = kwparameters or parameters
+        key = self._cache_key('get', query, args)
+        if key is not None:
+            hit, ret = self.result_cache.get(key)
+            if hit:
                 return ret
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                with self._event('get', query, args) as ev:
+                    try:
+                        await cur.execute(query, args)
+                        ret = await cur.fetchone()
+                    except pymysql.err.InternalError:
+                        await conn.ping()
+                        await cur.execute(query, args)
+                        ret = await cur.fetchone()
+                    ev.rows = 0 if ret is None else 1
+        if key is not None:
+            self.result_cache.put(key, ret)
+        return ret
 
     async def execute(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the lastrowid from the query."""
-        if not self.pool:
-            await self.init_pool()
-        async with self.pool.acquire() as conn:
+        args = kwparameters or parameters
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 try:
-                    await cur.execute(query, kwparameters or parameters)
-                except Exception:
-                    # https://github.com/aio-libs/aiomysql/issues/340
-                    await conn.ping()
-                    await cur.execute(query, kwparameters or parameters)
+                    with self._event('execute', query, args) as ev:
+                        try:
+                            await cur.execute(query, args)
+                        except Exception:
+                            if self._pinned() is not None:
+                                # a reconnect would lose the transaction
+                                raise
+                            # https://github.com/aio-libs/aiomysql/issues/340
+                            await conn.ping()
+                            await cur.execute(query, args)
+                        ev.rows = cur.rowcount
+                    await self._written(conn)
+                finally:
+                    self._invalidate(query)
                 return cur.lastrowid
 
     # =============== high level method for table ===================
 
     async def table_has(self, table_name, field, value):
-        sql = 'SELECT {} FROM {} WHERE {}=%s limit 1'.format(
-            field, table_name, field)
+        sql = cache.has_sql(table_name, field)
         d = await self.get(sql, value)
         return d
 
+    async def table_has_many(self, table_name, field, values,
+                             chunk_size=1000, prefilter=None):
+        '''Returns the set of values the field of the table has (as
+        MySQL returns them), checked by `field IN (...)` queries of
+        chunk_size values.
+
+        prefilter: a filter from membership_filter(), values not in it are
+                   taken as absent without asking MySQL
+        '''
+        values = [v for v in dict.fromkeys(values)
+                  if prefilter is None or v in prefilter]
+        present = set()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i+chunk_size]
+            sql = 'SELECT {0} FROM {1} WHERE {0} IN ({2})'.format(
+                field, table_name, ','.join(['%s'] * len(chunk)))
+            for row in await self.query(sql, *chunk):
+                present.add(membership.first_value(row))
+        return present
+
+    async def membership_filter(self, table_name, field, bloom=True,
+                                capacity=None, error_rate=0.01,
+                                batch_size=10000):
+        '''Returns a membership filter of all values of the field, warmed
+        by streaming the column with query_iter(). Use it as the prefilter
+        of table_has_many() or check `value in f` directly, and f.add()
+        the values inserted afterwards.
+
+        bloom: a BloomFilter with error_rate false positives and capacity
+               default to 1.5 * COUNT(*), else an exact but bigger SetFilter
+        The filter compares values exactly, a case-insensitive collation
+        of MySQL may take 'ABC' and 'abc' as the same, the filter doesn't.
+        '''
+        count = 0
+        if bloom and capacity is None:
+            count = membership.first_value(
+                await self.get('SELECT COUNT(*) FROM {}'.format(table_name)))
+        f = membership.make_filter(count, bloom, capacity, error_rate)
+        sql = 'SELECT {} FROM {}'.format(field, table_name)
+        async for row in self.query_iter(sql, batch_size=batch_size):
+            f.add(membership.first_value(row))
+        return f
+
     async def table_insert(self, table_name, item, ignore_duplicated=True):
         '''item is a dict : key is mysql table field'''
-        fields = list(item.keys())
+        fields = tuple(item)
         values = list(item.values())
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
+        sql = cache.insert_sql(table_name, fields)
         try:
             last_id = await self.execute(sql, *values)
             return last_id
@@ -148,19 +700,258 @@ class ConnectionAsync:
                     print(fields[i], ' : ', vs, type(values[i]))
             raise e
 
+    async def table_insert_many(self, table_name, items, fields=None,
+                                max_rows=1000, max_bytes=None,
+                                ignore_duplicated=True):
+        ''' items: list or iterable of item, written by multi-row
+        `INSERT ... VALUES (...),(...)` statements of at most max_rows rows
+        and max_bytes bytes (default to the server's max_allowed_packet).
+        fields: fields to insert, default to the keys of the first item.
+        Returns a list of inserted row counts, one for each statement.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        prefix = bulk.insert_prefix(table_name, fields)
+        return await self._execute_many_rows(
+            prefix, rows, max_rows, max_bytes,
+            ignore_duplicated=ignore_duplicated)
+
+    async def table_upsert_many(self, table_name, items, update_fields=None,
+                                ignore=False, fields=None,
+                                max_rows=1000, max_bytes=None):
+        '''Writes items in bulk like table_insert_many, but a row
+        duplicated on a unique key doesn't fail its whole statement:
+        with ignore it is skipped (INSERT IGNORE), otherwise its
+        update_fields are updated (INSERT ... ON DUPLICATE KEY UPDATE).
+
+        update_fields: fields to update on duplicated rows, default to all
+                       the fields written
+        Returns a list of affected row counts, one for each statement,
+        MySQL counts an inserted row as 1 and an updated one as 2.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        prefix, suffix = bulk.upsert_statement(
+            table_name, fields, update_fields, ignore)
+        return await self._execute_many_rows(
+            prefix, rows, max_rows, max_bytes, suffix,
+            ignore_duplicated=False)
+
+    async def table_load(self, table_name, items, fields=None,
+                         max_rows=100000, duplicates=None):
+        '''Loads items (a list or iterable of dict) into the table by
+        `LOAD DATA LOCAL INFILE`, much faster than INSERT for big fills.
+        Every max_rows items are written to a temporary tab-separated file
+        and loaded by one statement, the file is removed afterwards.
+        It needs ConnectionAsync(..., local_infile=True) and local_infile=ON
+        on the server.
+
+        fields: fields to load, default to the keys of the first item
+        duplicates: None, 'ignore' or 'replace' for rows duplicated on a
+                    unique key, None makes such a row an error
+        Returns a list of {'rows': loaded rows, 'warnings': [(level, code,
+        message), ...]}, one for each chunk.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        sql = bulk.load_data_sql(table_name, fields, duplicates)
+        results = []
+        loop = asyncio.get_running_loop()
+        async with self._acquire() as conn:
+            async with conn.cursor(aiomysql.cursors.Cursor) as cur:
+                try:
+                    for chunk in bulk.chunks(rows, max_rows):
+                        # don't block the loop on writing a big file
+                        fn = await loop.run_in_executor(
+                            None, bulk.write_tsv_file, chunk)
+                        try:
+                            with self._event('table_load', sql) as ev:
+                                await cur.execute(sql, (fn,))
+                                loaded = ev.rows = cur.rowcount
+                        finally:
+                            os.remove(fn)
+                        await cur.execute('SHOW WARNINGS')
+                        results.append({
+                            'rows': loaded,
+                            'warnings': list(await cur.fetchall()),
+                        })
+                        await self._written(conn)
+                finally:
+                    self._invalidate(sql)
+        return results
+
+    async def _max_allowed_packet(self, conn):
+        if self._max_packet is None:
+            async with conn.cursor(aiomysql.cursors.Cursor) as cur:
+                await cur.execute('SELECT @@max_allowed_packet')
+                server = (await cur.fetchone())[0]
+            client = getattr(conn, 'max_allowed_packet', server)
+            self._max_packet = min(server, client)
+        return self._max_packet
+
+    async def _execute_many_rows(self, prefix, rows, max_rows, max_bytes,
+                                 suffix='', ignore_duplicated=True):
+        def statements(literal, max_bytes):
+            return bulk.multirow_statements(
+                prefix, rows, literal, max_rows, max_bytes, suffix)
+        return await self._execute_statements(
+            statements, max_bytes, prefix, ignore_duplicated)
+
+    async def _execute_statements(self, statements, max_bytes, write_sql,
+                                  ignore_duplicated=False):
+        '''Executes the (sql, row count) pairs from
+        statements(literal, max_bytes) on one connection, returns the
+        affected row counts. write_sql tells the table written.'''
+        counts = []
+        async with self._acquire() as conn:
+            if max_bytes is None:
+                max_bytes = await self._max_allowed_packet(conn)
+            async with conn.cursor() as cur:
+                try:
+                    for sql, _ in statements(conn.escape, max_bytes):
+                        try:
+                            with self._event('execute_many', sql) as ev:
+                                await cur.execute(sql)
+                                ev.rows = cur.rowcount
+                            counts.append(cur.rowcount)
+                            await self._written(conn)
+                        except Exception as e:
+                            if ignore_duplicated and e.args[0] == 1062:
+                                # just skip duplicated item
+                                counts.append(0)
+                                continue
+                            traceback.print_exc()
+                            print('sql:', sql[:300])
+                            raise e
+                finally:
+                    self._invalidate(write_sql)
+        return counts
+
+    def writer(self, table_name, max_rows=1000, max_delay=1.0, fields=None):
+        '''Returns an AsyncWriter which coalesces `await writer.add(item)`
+        calls into table_insert_many() batches.'''
+        return AsyncWriter(self, table_name, max_rows, max_delay, fields)
+
+    async def table_update_many(self, table_name, rows, key_field,
+                                max_rows=1000, max_bytes=None):
+        '''rows: list or iterable of dict, each has key_field and the
+        fields to update of the row whose key_field equals to it.
+        Rows are updated by statements of at most max_rows rows, like
+        `UPDATE t SET f=CASE key WHEN k1 THEN v1 ... ELSE f END
+        WHERE key IN (k1, ...)`, max_bytes defaults to max_allowed_packet.
+        Returns a list of changed row counts, one for each statement.
+        An update clashing on a unique key raises, its statement and the
+        ones after it are not applied.
+        '''
+        def statements(literal, max_bytes):
+            return bulk.update_many_statements(
+                table_name, rows, key_field, literal, max_rows, max_bytes)
+        return await self._execute_statements(
+            statements, max_bytes, 'UPDATE ' + table_name,
+            ignore_duplicated=False)
+
     async def table_update(self, table_name, updates,
                            field_where, value_where):
         '''updates is a dict of {field_update:value_update}'''
-        upsets = []
-        values = []
-        for k, v in updates.items():
-            s = '{}=%s'.format(k)
-            upsets.append(s)
-            values.append(v)
-        upsets = ','.join(upsets)
-        sql = 'UPDATE {} SET {} WHERE {}="{}"'.format(
-            table_name,
-            upsets,
-            field_where, value_where,
-        )
-        await self.execute(sql, *(values))
+        sql = cache.update_sql(table_name, tuple(updates), field_where)
+        values = list(updates.values())
+        values.append(value_where)
+        await self.execute(sql, *values)
+
+
+class AsyncWriter:
+    '''Buffers items and writes them to a table in multi-row INSERTs,
+    when max_rows items are waiting or max_delay seconds after the first
+    one came in, whichever happens first.
+
+        async with db.writer('tbl', max_rows=500, max_delay=0.5) as writer:
+            for item in items:
+                await writer.add(item)
+
+    Items still in the buffer are written on close() (or leaving the
+    `async with` block), remember to close it if not used as a context.
+    A flush writes max_rows items at a time. If the connection is lost,
+    the items not written yet go back to the buffer for the next flush;
+    any other error drops the items of the failing write, counted in
+    rows_dropped, as writing them again would fail again. The error of
+    a write in the background is raised by the next add().
+    '''
+    def __init__(self, db, table_name, max_rows=1000, max_delay=1.0,
+                 fields=None):
+        self._db = db
+        self.table_name = table_name
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.fields = fields
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self._items = []
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._error = None
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def add(self, item):
+        if self._closed:
+            raise RuntimeError('writer of {} is closed'.format(
+                self.table_name))
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        self._items.append(item)
+        if len(self._items) >= self.max_rows:
+            # the caller waits for the batch written, as backpressure
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            traceback.print_exc()
+            self._error = e
+
+    async def flush(self):
+        '''Writes out all buffered items, returns the row counts.'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            items, self._items = self._items, []
+            counts = []
+            for start in range(0, len(items), self.max_rows):
+                chunk = items[start:start + self.max_rows]
+                try:
+                    written = await self._db.table_insert_many(
+                        self.table_name, chunk, self.fields, self.max_rows)
+                except BaseException as e:
+                    if (isinstance(e, asyncio.CancelledError) or
+                            is_connection_error(e)):
+                        # not lost, written by the next flush or close()
+                        self._items[:0] = items[start:]
+                    else:
+                        # a bad row or constraint, it would fail forever
+                        self._items[:0] = items[start + self.max_rows:]
+                        self.rows_dropped += len(chunk)
+                    raise
+                counts.extend(written)
+                self.rows_written += sum(written)
+            return counts
+
+    async def close(self):
+        '''Writes out the buffer, raises if it can't be written.'''
+        self._closed = True
+        await self.flush()
+        self._error = None
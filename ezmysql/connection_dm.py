@@ -2,10 +2,24 @@
 Only for python 3
 """
 
+import contextlib
 import time
 import traceback
 import dmPython
 
+from . import bulk
+from . import cache
+from .instrument import NO_EVENT
+from .pool import SyncPool
+
+# DM's unique constraint violation, its message reads
+# "[CODE:-6602]违反表[...]唯一性约束"
+DM_DUPLICATE = -6602
+
+
+def is_duplicate(e):
+    return '[CODE:{}]'.format(DM_DUPLICATE) in str(e)
+
 
 class ConnectionDM:
     def __init__(self, host, database, user, password,
@@ -14,7 +28,21 @@ class ConnectionDM:
                  connect_timeout=10,
                  autocommit=True,
                  return_dict=True,
-                 charset="utf8mb4"):
+                 charset="utf8mb4",
+                 instrument=None,
+                 pool_size=0,
+                 max_overflow=0,
+                 pool_timeout=30):
+        '''
+        instrument: an instrument.Instrumentation to time every statement
+        pool_size: > 0 to check a connection out of a thread-safe pool
+                   per call instead of sharing one connection, with
+                   autocommit off each call is committed (rolled back if
+                   it fails) before its connection goes back
+        max_overflow: connections opened beyond pool_size under load,
+                      they are closed when given back
+        pool_timeout: seconds to wait for a free pooled connection
+        '''
         self.max_idle_time = max_idle_time
         self._db_args = {
             'host': host,
@@ -25,11 +53,22 @@ class ConnectionDM:
         if return_dict:
             self._db_args['cursorclass'] = dmPython.DictCursor
         self._autocommit = autocommit
+        self.instrument = instrument
         if port:
             self._db_args['port'] = port
         self._db = None
+        self._pool = None
         self._last_use_time = time.time()
-        self.reconnect()
+        if pool_size > 0:
+            self._pool = SyncPool(
+                self._connect,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                max_idle_time=max_idle_time,
+                timeout=pool_timeout,
+                on_close=self._commit_on_close)
+        else:
+            self.reconnect()
 
     def _ensure_connected(self):
         if (self._db is None or
@@ -37,101 +76,132 @@ class ConnectionDM:
             self.reconnect()
         self._last_use_time = time.time()
 
-    def _cursor(self):
-        self._ensure_connected()
-        return self._db.cursor()
+    @contextlib.contextmanager
+    def _connection(self):
+        """Yields the shared connection, or checks one out of the pool
+        for the duration of a call when pooling is on."""
+        if self._pool is None:
+            self._ensure_connected()
+            yield self._db
+            return
+        conn = self._pool.acquire()
+        broken = False
+        try:
+            yield conn
+            if not self._autocommit:
+                # not to sit in the pool holding locks of its writes
+                conn.commit()
+        except BaseException as e:
+            # lost connection and alike, don't give it to the next caller
+            broken = isinstance(e, (dmPython.OperationalError,
+                                    dmPython.InterfaceError))
+            if not broken and not self._autocommit:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self._pool.release(conn, discard=broken)
+
+    @contextlib.contextmanager
+    def _cursor_ctx(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _event(self, method, query, args=None):
+        if self.instrument is None:
+            return NO_EVENT
+        return self.instrument.event(method, query, args)
 
     def __del__(self):
         self.close()
 
+    def _connect(self):
+        return dmPython.connect(**self._db_args)
+
+    def _commit_on_close(self, conn):
+        if not self._autocommit:
+            conn.commit()
+
     def close(self):
         """Closes this database connection."""
         if getattr(self, "_db", None) is not None:
-            if not self._autocommit:
-                self._db.commit()
+            self._commit_on_close(self._db)
             self._db.close()
             self._db = None
+        if getattr(self, "_pool", None) is not None:
+            self._pool.close()
 
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
         self.close()
-        self._db = dmPython.connect(**self._db_args)
+        if self._pool is None:
+            self._db = self._connect()
 
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            # if self._return_dict:
-            #     columns = [col[0] for col in cursor.description]
-            #     cursor.rowfactory = lambda *args: dict(zip(columns, args))
-            #     # cursor.rowfactory = lambda *args: dict(zip(columns, [str(a) if isinstance(a, oracledb.LOB) else a for a in args]))
-            #     # cursor.rowfactory = lambda *args: dict(zip(columns, map(str, args)))
-            result = cursor.fetchall()
+        with self._cursor_ctx() as cursor:
+            args = kwparameters or parameters
+            with self._event('query', query, args) as ev:
+                cursor.execute(query, args)
+                result = cursor.fetchall()
+                ev.rows = len(result)
             return result
-        finally:
-            cursor.close()
 
     def get(self, query, *parameters, **kwparameters):
         """Returns the (singular) row returned by the given query.
         """
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            # if self._return_dict:
-            #     columns = [col[0] for col in cursor.description]
-            #     # cursor.rowfactory = lambda *args: dict(zip(columns, map(str, args)))
-            #     # cursor.rowfactory = lambda *args: dict(zip(columns, [str(a) if isinstance(a, oracledb.LOB) else a for a in args]))
-            #     cursor.rowfactory = lambda *args: dict(zip(columns, args))
-            return cursor.fetchone()
-        finally:
-            cursor.close()
+        with self._cursor_ctx() as cursor:
+            args = kwparameters or parameters
+            with self._event('get', query, args) as ev:
+                cursor.execute(query, args)
+                row = cursor.fetchone()
+                ev.rows = 0 if row is None else 1
+            return row
 
     def execute(self, query, *parameters, **kwparameters):
-        """Executes the given query, returning the lastrowid from the query."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            if self._autocommit:
-                self._db.commit()
-            return cursor.lastrowid
-        except Exception as e:
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                raise e
-        finally:
-            cursor.close()
+        """Executes the given query, returning the lastrowid from the query.
+        With autocommit the driver commits it, no extra round trip."""
+        with self._cursor_ctx() as cursor:
+            try:
+                args = kwparameters or parameters
+                with self._event('execute', query, args) as ev:
+                    cursor.execute(query, args)
+                    ev.rows = cursor.rowcount
+                return cursor.lastrowid
+            except Exception as e:
+                if is_duplicate(e):
+                    # just skip duplicated item error
+                    pass
+                else:
+                    traceback.print_exc()
+                    raise e
 
     insert = execute
 
     # =============== high level method for table ===================
 
     def table_has(self, table_name, field, value):
-        sql = 'SELECT {} FROM {} WHERE {}="{}"'.format(
-            field,
-            table_name,
-            field,
-            value)
-        d = self.get(sql)
+        sql = cache.has_sql(table_name, field, 'qmark')
+        d = self.get(sql, value)
         return d
 
     def table_insert(self, table_name, item):
         '''item is a dict : key is mysql table field'''
         fields = list(item.keys())
         values = list(item.values())
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
+        sql = cache.insert_sql(table_name, tuple(fields), 'qmark')
         try:
             last_id = self.execute(sql, *values)
             return last_id
         except Exception as e:
             print(e)
-            if e.args[0] == 1062:
+            if is_duplicate(e):
                 # just skip duplicated item error
                 pass
             else:
@@ -146,46 +216,56 @@ class ConnectionDM:
                         print(fields[i], ' : ', vs, type(values[i]))
                 raise e
 
-    def table_insert_many(self, table_name, items):
-        ''' items: list of item'''
-        assert isinstance(items, list)
-        item = items[0]
-        fields = list(item.keys())
-        values = [list(item.values()) for item in items]
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
-        cursor = self._cursor()
-        try:
-            last_id = cursor.executemany(sql, values)
-            return last_id
-        except Exception as e:
-            print('\t', e)
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                print('sql:', sql)
-                raise e
+    def table_insert_many(self, table_name, items, fields=None,
+                          max_rows=1000):
+        ''' items: list or iterable of item, written by executemany()
+        in chunks of at most max_rows rows with ? placeholders. The
+        driver's autocommit is off meanwhile, so that a chunk is one
+        transaction with a single commit rather than a commit per row.
+        fields: fields to insert, default to the keys of the first item.
+        Returns a list of inserted row counts, one for each chunk.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        sql = cache.insert_sql(table_name, tuple(fields), 'qmark')
+        counts = []
+        with self._connection() as conn:
+            if self._autocommit:
+                conn.autoCommit = False
+            cursor = conn.cursor()
+            try:
+                for chunk in bulk.chunks(rows, max_rows):
+                    try:
+                        with self._event('executemany', sql) as ev:
+                            cursor.executemany(sql, chunk)
+                            ev.rows = cursor.rowcount
+                        if self._autocommit:
+                            conn.commit()
+                        counts.append(cursor.rowcount)
+                    except Exception as e:
+                        print('\t', e)
+                        if self._autocommit:
+                            conn.rollback()
+                        if is_duplicate(e):
+                            # just skip duplicated item error
+                            counts.append(0)
+                        else:
+                            traceback.print_exc()
+                            print('sql:', sql)
+                            raise e
+            finally:
+                cursor.close()
+                if self._autocommit:
+                    conn.autoCommit = True
+        return counts
 
     def table_update(self, table_name, updates,
                      field_where, value_where):
         '''updates is a dict of {field_update:value_update}'''
-        upsets = []
-        values = []
-        for k, v in updates.items():
-            s = '{}=%s'.format(k)
-            upsets.append(s)
-            values.append(v)
-        upsets = ','.join(upsets)
-        sql = 'UPDATE {} SET {} WHERE {}="{}"'.format(
-            table_name,
-            upsets,
-            field_where, value_where,
-        )
-        self.execute(sql, *(values))
+        sql = cache.update_sql(table_name, tuple(updates), field_where,
+                               'qmark')
+        self.execute(sql, *updates.values(), value_where)
 
 
 if __name__ == "__main__":
@@ -2,16 +2,87 @@
 Only for python 3
 """
 
+import contextlib
+import threading
 import time
 import traceback
 import oracledb
 
+from . import bulk
+from . import cache
+from . import columns
+from .instrument import NO_EVENT
+from .row import Row, row_index
+
+# ORA-00001: unique constraint violated, Oracle's 1062
+ORA_DUPLICATE = 1
+
 
 def rowfactory(columns, args):
     args = [str(a) if isinstance(a, oracledb.CLOB) else a for a in args]
     return dict(zip(columns, args))
 
 
+_thick_lock = threading.Lock()
+_thick_initialized = False
+
+
+def init_thick_mode(lib_dir=None):
+    '''Loads the Oracle Client libraries for thick mode once for the
+    process, it is slow and can't be undone.'''
+    global _thick_initialized
+    with _thick_lock:
+        if not _thick_initialized:
+            oracledb.init_oracle_client(lib_dir=lib_dir)
+            _thick_initialized = True
+
+
+def is_duplicate(e):
+    error = e.args[0] if e.args else None
+    return getattr(error, 'code', None) == ORA_DUPLICATE
+
+
+def output_type_handler(cursor, metadata):
+    '''Fetches CLOB/NCLOB as str and BLOB as bytes in the row itself,
+    saving a round trip per LOB to read it.'''
+    if metadata.type_code is oracledb.DB_TYPE_CLOB:
+        return cursor.var(oracledb.DB_TYPE_LONG, arraysize=cursor.arraysize)
+    if metadata.type_code is oracledb.DB_TYPE_NCLOB:
+        return cursor.var(oracledb.DB_TYPE_LONG_NVARCHAR,
+                          arraysize=cursor.arraysize)
+    if metadata.type_code is oracledb.DB_TYPE_BLOB:
+        return cursor.var(oracledb.DB_TYPE_LONG_RAW,
+                          arraysize=cursor.arraysize)
+    return None
+
+
+class RowFactories:
+    '''Row factories by the column names of a result, made once for
+    every shape of result rather than once a query.'''
+    def __init__(self, return_dict=True, compact_rows=False):
+        self.return_dict = return_dict
+        self.compact_rows = compact_rows
+        self._factories = cache.LRUCache(maxsize=256)
+
+    def get(self, description):
+        if description is None:
+            return None
+        if not (self.compact_rows or self.return_dict):
+            return None
+        names = tuple([col[0] for col in description])
+        factory = self._factories.get(names)
+        if factory is None:
+            factory = self._make(names)
+            self._factories.put(names, factory)
+        return factory
+
+    def _make(self, names):
+        if self.compact_rows:
+            index = row_index(names)
+            return lambda *args: Row(args, index)
+        return lambda *args: dict(zip(names, args))
+
+
 class ConnectionOracle:
     def __init__(self, host, database, user, password,
                  port=1521,
@@ -19,7 +90,39 @@ class ConnectionOracle:
                  connect_timeout=10,
                  autocommit=True,
                  return_dict=True,
-                 charset="utf8mb4"):
+                 charset="utf8mb4",
+                 compact_rows=False,
+                 instrument=None,
+                 arraysize=None,
+                 prefetchrows=None,
+                 fetch_lobs=False,
+                 thick_mode=True,
+                 lib_dir=None,
+                 pool_min=1,
+                 pool_max=0,
+                 pool_increment=1,
+                 pool_timeout=30):
+        '''
+        compact_rows: return rows as row.Row, a tuple with a shared column
+                      index, which reads like a dict but costs less memory
+        instrument: an instrument.Instrumentation to time every statement
+        arraysize: rows a fetch round trip gets, raise it (e.g. 1000) for
+                   big results, None keeps oracledb's default of 100
+        prefetchrows: rows sent along with the execute, None keeps
+                      oracledb's default of 2, set arraysize + 1 for
+                      results known to be small
+        fetch_lobs: return CLOB/NCLOB/BLOB as LOB objects to read later,
+                    by default they are str and bytes in the rows
+        thick_mode: load the Oracle Client libraries (from lib_dir) as
+                    before, False runs python-oracledb in thin mode, which
+                    starts faster and needs no client install
+        pool_max: if > 0, use a session pool of pool_min to pool_max
+                  connections, growing by pool_increment, so that threads
+                  can share this object, every call gets a connection of
+                  the pool and gives it back; waits at most pool_timeout
+                  seconds for one. Uncommitted work is committed when the
+                  connection goes back.
+        '''
         self.max_idle_time = max_idle_time
         self._db_args = {
             'host': host,
@@ -27,14 +130,27 @@ class ConnectionOracle:
             'user': user,
             'password': password,
         }
-        self._return_dict = return_dict
+        self._rowfactories = RowFactories(return_dict, compact_rows)
+        self._arraysize = arraysize
+        self._prefetchrows = prefetchrows
+        self._fetch_lobs = fetch_lobs
         self._autocommit = autocommit
+        self.instrument = instrument
         if port:
             self._db_args['port'] = port
         self._db = None
+        self._pool = None
         self._last_use_time = time.time()
-        oracledb.init_oracle_client()
-        self.reconnect()
+        if thick_mode:
+            init_thick_mode(lib_dir)
+        if pool_max:
+            self._pool = oracledb.create_pool(
+                min=pool_min, max=pool_max, increment=pool_increment,
+                getmode=oracledb.POOL_GETMODE_TIMEDWAIT,
+                wait_timeout=int(pool_timeout * 1000),
+                **self._db_args)
+        else:
+            self.reconnect()
 
     def _ensure_connected(self):
         if (self._db is None or
@@ -42,101 +158,162 @@ class ConnectionOracle:
             self.reconnect()
         self._last_use_time = time.time()
 
-    def _cursor(self):
-        self._ensure_connected()
-        return self._db.cursor()
+    def _prepare(self, conn):
+        if not self._fetch_lobs:
+            conn.outputtypehandler = output_type_handler
+        return conn
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Yields the shared connection, or one of the session pool for
+        the duration of a call when pooling is on."""
+        if self._pool is None:
+            self._ensure_connected()
+            yield self._db
+            return
+        conn = self._prepare(self._pool.acquire())
+        try:
+            yield conn
+            if not self._autocommit:
+                # the pool rolls back what a connection gives back
+                conn.commit()
+        finally:
+            self._pool.release(conn)
+
+    @contextlib.contextmanager
+    def _cursor_ctx(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self._arraysize:
+                cursor.arraysize = self._arraysize
+            if self._prefetchrows is not None:
+                cursor.prefetchrows = self._prefetchrows
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _event(self, method, query, args=None):
+        if self.instrument is None:
+            return NO_EVENT
+        return self.instrument.event(method, query, args)
 
     def __del__(self):
         self.close()
 
-    def close(self):
-        """Closes this database connection."""
+    def _close_db(self):
         if getattr(self, "_db", None) is not None:
             if not self._autocommit:
                 self._db.commit()
             self._db.close()
             self._db = None
 
+    def close(self):
+        """Closes this database connection, or the session pool."""
+        self._close_db()
+        if getattr(self, "_pool", None) is not None:
+            self._pool.close(force=True)
+            self._pool = None
+
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
-        self.close()
-        self._db = oracledb.connect(**self._db_args)
+        self._close_db()
+        if self._pool is None:
+            self._db = self._prepare(oracledb.connect(**self._db_args))
+
+    def _set_rowfactory(self, cursor):
+        factory = self._rowfactories.get(cursor.description)
+        if factory is not None:
+            cursor.rowfactory = factory
 
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            if self._return_dict:
-                columns = [col[0] for col in cursor.description]
-                cursor.rowfactory = lambda *args: dict(zip(columns, args))
-                # cursor.rowfactory = lambda *args: dict(zip(columns, [str(a) if isinstance(a, oracledb.LOB) else a for a in args]))
-                # cursor.rowfactory = lambda *args: dict(zip(columns, map(str, args)))
-            result = cursor.fetchall()
+        with self._cursor_ctx() as cursor:
+            args = kwparameters or parameters
+            with self._event('query', query, args) as ev:
+                cursor.execute(query, args)
+                self._set_rowfactory(cursor)
+                result = cursor.fetchall()
+                ev.rows = len(result)
             return result
-        finally:
-            cursor.close()
+
+    def query_columns(self, query, *parameters, batch_size=10000,
+                      use_numpy=True, **kwparameters):
+        """Returns {column: values} for the given query, rows are fetched
+        `batch_size` at a time into one list per column. With numpy
+        installed and use_numpy, NUMBER, BINARY_FLOAT/DOUBLE, DATE and
+        TIMESTAMP columns are numpy arrays (NULL as NaN or NaT), other
+        columns stay lists.
+        """
+        with self._cursor_ctx() as cursor:
+            cursor.arraysize = batch_size
+            args = kwparameters or parameters
+            with self._event('query_columns', query, args) as ev:
+                cursor.execute(query, args)
+                collector = columns.ColumnCollector(
+                    cursor.description,
+                    columns.oracle_kinds(cursor.description))
+                n = 0
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    n += len(rows)
+                    collector.add(rows)
+                ev.rows = n
+        return collector.result(use_numpy)
 
     def get(self, query, *parameters, **kwparameters):
         """Returns the (singular) row returned by the given query.
         """
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            if self._return_dict:
-                columns = [col[0] for col in cursor.description]
-                # cursor.rowfactory = lambda *args: dict(zip(columns, map(str, args)))
-                # cursor.rowfactory = lambda *args: dict(zip(columns, [str(a) if isinstance(a, oracledb.LOB) else a for a in args]))
-                cursor.rowfactory = lambda *args: dict(zip(columns, args))
-            return cursor.fetchone()
-        finally:
-            cursor.close()
+        with self._cursor_ctx() as cursor:
+            args = kwparameters or parameters
+            with self._event('get', query, args) as ev:
+                cursor.execute(query, args)
+                self._set_rowfactory(cursor)
+                row = cursor.fetchone()
+                ev.rows = 0 if row is None else 1
+            return row
 
     def execute(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the lastrowid from the query."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            if self._autocommit:
-                self._db.commit()
-            return cursor.lastrowid
-        except Exception as e:
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                raise e
-        finally:
-            cursor.close()
+        with self._cursor_ctx() as cursor:
+            try:
+                args = kwparameters or parameters
+                with self._event('execute', query, args) as ev:
+                    cursor.execute(query, args)
+                    ev.rows = cursor.rowcount
+                if self._autocommit:
+                    cursor.connection.commit()
+                return cursor.lastrowid
+            except Exception as e:
+                if is_duplicate(e):
+                    # just skip duplicated item error
+                    pass
+                else:
+                    traceback.print_exc()
+                    raise e
 
     insert = execute
 
     # =============== high level method for table ===================
 
     def table_has(self, table_name, field, value):
-        sql = 'SELECT {} FROM {} WHERE {}="{}"'.format(
-            field,
-            table_name,
-            field,
-            value)
-        d = self.get(sql)
+        sql = cache.has_sql(table_name, field, 'numeric')
+        d = self.get(sql, value)
         return d
 
     def table_insert(self, table_name, item):
         '''item is a dict : key is mysql table field'''
         fields = list(item.keys())
         values = list(item.values())
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
+        sql = cache.insert_sql(table_name, tuple(fields), 'numeric')
         try:
             last_id = self.execute(sql, *values)
             return last_id
         except Exception as e:
             print(e)
-            if e.args[0] == 1062:
+            if is_duplicate(e):
                 # just skip duplicated item error
                 pass
             else:
@@ -151,43 +328,42 @@ class ConnectionOracle:
                         print(fields[i], ' : ', vs, type(values[i]))
                 raise e
 
-    def table_insert_many(self, table_name, items):
-        ''' items: list of item'''
-        assert isinstance(items, list)
-        item = items[0]
-        fields = list(item.keys())
-        values = [list(item.values()) for item in items]
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
-        cursor = self._cursor()
-        try:
-            last_id = cursor.executemany(sql, values)
-            return last_id
-        except Exception as e:
-            print('\t', e)
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                print('sql:', sql)
-                raise e
+    def table_insert_many(self, table_name, items, fields=None,
+                          max_rows=1000):
+        ''' items: list or iterable of item, written by array DML
+        (executemany() with batcherrors) in chunks of at most max_rows rows,
+        committed chunk by chunk.
+        fields: fields to insert, default to the keys of the first item.
+        Rows violating a unique constraint are skipped, any other error
+        rolls back what is not committed yet and is raised.
+        Returns a list of inserted row counts, one for each chunk.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        sql = cache.insert_sql(table_name, tuple(fields), 'numeric')
+        counts = []
+        with self._cursor_ctx() as cursor:
+            for chunk in bulk.chunks(rows, max_rows):
+                with self._event('executemany', sql) as ev:
+                    cursor.executemany(sql, chunk, batcherrors=True)
+                    ev.rows = cursor.rowcount
+                errors = [e for e in cursor.getbatcherrors()
+                          if e.code != ORA_DUPLICATE]
+                if errors:
+                    cursor.connection.rollback()
+                    for error in errors[:10]:
+                        print('\trow', error.offset, ':', error.message)
+                    print('sql:', sql)
+                    raise oracledb.DatabaseError(errors[0])
+                if self._autocommit:
+                    cursor.connection.commit()
+                counts.append(cursor.rowcount)
+        return counts
 
     def table_update(self, table_name, updates,
                      field_where, value_where):
         '''updates is a dict of {field_update:value_update}'''
-        upsets = []
-        values = []
-        for k, v in updates.items():
-            s = '{}=%s'.format(k)
-            upsets.append(s)
-            values.append(v)
-        upsets = ','.join(upsets)
-        sql = 'UPDATE {} SET {} WHERE {}="{}"'.format(
-            table_name,
-            upsets,
-            field_where, value_where,
-        )
-        self.execute(sql, *(values))
+        sql = cache.update_sql(table_name, tuple(updates), field_where,
+                               'numeric')
+        self.execute(sql, *updates.values(), value_where)
@@ -0,0 +1,303 @@
+"""A lightweight wrapper around the asyncio API of oracledb for easy to use
+Only for python 3
+"""
+
+import asyncio
+import contextlib
+import time
+import traceback
+import oracledb
+
+from . import bulk
+from . import cache
+from . import columns
+from .connection_oracle import (ORA_DUPLICATE, RowFactories, is_duplicate,
+                                output_type_handler)
+from .instrument import NO_EVENT
+
+
+class ConnectionOracleAsync:
+    '''ConnectionAsync for Oracle: the same methods to await, on a pool of
+    python-oracledb's asyncio connections, so that Oracle calls share the
+    event loop instead of blocking it. Only works in thin mode, don't
+    create a ConnectionOracle with thick_mode=True in the same process.
+    Its close() is a coroutine: `await db.close()`.
+    '''
+    def __init__(self, host, database, user, password,
+                 port=1521,
+                 minsize=3, maxsize=5,
+                 increment=1,
+                 pool_timeout=30,
+                 autocommit=True,
+                 return_dict=True,
+                 compact_rows=False,
+                 instrument=None,
+                 arraysize=None,
+                 prefetchrows=None,
+                 fetch_lobs=False,
+                 **kwargs):
+        '''
+        minsize, maxsize, increment: connections of the pool, opened
+                                     increment at a time
+        pool_timeout: seconds to wait for a free connection of the pool
+        compact_rows: return rows as row.Row, a tuple with a shared column
+                      index, which reads like a dict but costs less memory
+        instrument: an instrument.Instrumentation to time every statement
+                    and the wait for a pool connection
+        arraysize, prefetchrows, fetch_lobs: as of ConnectionOracle
+        kwargs: all parameters that oracledb.create_pool_async() accept.
+        '''
+        self.db_args = {
+            'host': host,
+            'service_name': database,
+            'user': user,
+            'password': password,
+            'min': minsize,
+            'max': maxsize,
+            'increment': increment,
+            'getmode': oracledb.POOL_GETMODE_TIMEDWAIT,
+            'wait_timeout': int(pool_timeout * 1000),
+        }
+        if port:
+            self.db_args['port'] = port
+        if kwargs:
+            self.db_args.update(kwargs)
+        self.pool = None
+        self._autocommit = autocommit
+        self._rowfactories = RowFactories(return_dict, compact_rows)
+        self._arraysize = arraysize
+        self._prefetchrows = prefetchrows
+        self._fetch_lobs = fetch_lobs
+        self.instrument = instrument
+
+    async def close(self):
+        """Closes the pool. Unlike ConnectionAsync.close() it is a
+        coroutine, oracledb's pool is closed by awaiting it."""
+        if self.pool is not None:
+            pool = self.pool
+            self.pool = None
+            await pool.close(force=True)
+
+    async def init_pool(self):
+        self.pool = oracledb.create_pool_async(**self.db_args)
+
+    async def warm_up(self):
+        """Creates the pool and opens its minsize connections now rather
+        than in the first request, returns the number of connections
+        open. Call it at startup."""
+        if not self.pool:
+            await self.init_pool()
+        conns = []
+        try:
+            for _ in range(self.pool.min):
+                conns.append(await self.pool.acquire())
+        finally:
+            for conn in conns:
+                await self.pool.release(conn)
+        return self.pool.opened
+
+    @contextlib.asynccontextmanager
+    async def _acquire(self):
+        """Acquires a connection of the pool, creating the pool first
+        if needed."""
+        if not self.pool:
+            await self.init_pool()
+        pool = self.pool
+        if self.instrument is None:
+            conn = await pool.acquire()
+        else:
+            start = time.perf_counter()
+            conn = await pool.acquire()
+            self.instrument.record_pool_wait(time.perf_counter() - start)
+        if not self._fetch_lobs:
+            conn.outputtypehandler = output_type_handler
+        try:
+            yield conn
+            if not self._autocommit:
+                # the pool rolls back what a connection gives back
+                await conn.commit()
+        finally:
+            await pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def _cursor_ctx(self):
+        async with self._acquire() as conn:
+            cursor = conn.cursor()
+            if self._arraysize:
+                cursor.arraysize = self._arraysize
+            if self._prefetchrows is not None:
+                cursor.prefetchrows = self._prefetchrows
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _event(self, method, query, args=None):
+        if self.instrument is None:
+            return NO_EVENT
+        return self.instrument.event(method, query, args)
+
+    def _set_rowfactory(self, cursor):
+        factory = self._rowfactories.get(cursor.description)
+        if factory is not None:
+            cursor.rowfactory = factory
+
+    async def query_many(self, queries, parallel=False,
+                         return_exceptions=False):
+        """query many SQLs, Returns all result.
+
+        parallel: run the queries at the same time, each on its own pool
+                  connection
+        return_exceptions: put the exception of a failed query into the
+                           results instead of raising it
+        """
+        if not self.pool:
+            await self.init_pool()
+        if parallel:
+            results = await asyncio.gather(
+                *[self.query(q) for q in queries],
+                return_exceptions=return_exceptions)
+            return list(results)
+        results = []
+        async with self._cursor_ctx() as cursor:
+            for query in queries:
+                try:
+                    with self._event('query_many', query) as ev:
+                        await cursor.execute(query)
+                        self._set_rowfactory(cursor)
+                        ret = await cursor.fetchall()
+                        ev.rows = len(ret)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    ret = e
+                results.append(ret)
+        return results
+
+    async def query(self, query, *parameters, **kwparameters):
+        """Returns a row list for the given query and parameters."""
+        args = kwparameters or parameters
+        async with self._cursor_ctx() as cursor:
+            with self._event('query', query, args) as ev:
+                await cursor.execute(query, args)
+                self._set_rowfactory(cursor)
+                result = await cursor.fetchall()
+                ev.rows = len(result)
+        return result
+
+    async def query_columns(self, query, *parameters, batch_size=10000,
+                            use_numpy=True, **kwparameters):
+        """Returns {column: values} for the given query, as
+        ConnectionOracle.query_columns() does."""
+        args = kwparameters or parameters
+        async with self._cursor_ctx() as cursor:
+            cursor.arraysize = batch_size
+            with self._event('query_columns', query, args) as ev:
+                await cursor.execute(query, args)
+                collector = columns.ColumnCollector(
+                    cursor.description,
+                    columns.oracle_kinds(cursor.description))
+                n = 0
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    n += len(rows)
+                    collector.add(rows)
+                ev.rows = n
+        return collector.result(use_numpy)
+
+    async def get(self, query, *parameters, **kwparameters):
+        """Returns the (singular) row returned by the given query.
+        """
+        args = kwparameters or parameters
+        async with self._cursor_ctx() as cursor:
+            with self._event('get', query, args) as ev:
+                await cursor.execute(query, args)
+                self._set_rowfactory(cursor)
+                row = await cursor.fetchone()
+                ev.rows = 0 if row is None else 1
+        return row
+
+    async def execute(self, query, *parameters, **kwparameters):
+        """Executes the given query, returning the lastrowid from the query.
+        Like ConnectionAsync.execute() it raises a duplicated row error,
+        table_insert() is the one skipping it."""
+        args = kwparameters or parameters
+        async with self._cursor_ctx() as cursor:
+            with self._event('execute', query, args) as ev:
+                await cursor.execute(query, args)
+                ev.rows = cursor.rowcount
+            if self._autocommit:
+                await cursor.connection.commit()
+            return cursor.lastrowid
+
+    insert = execute
+
+    # =============== high level method for table ===================
+
+    async def table_has(self, table_name, field, value):
+        sql = cache.has_sql(table_name, field, 'numeric')
+        d = await self.get(sql, value)
+        return d
+
+    async def table_insert(self, table_name, item, ignore_duplicated=True):
+        '''item is a dict : key is mysql table field'''
+        fields = list(item.keys())
+        values = list(item.values())
+        sql = cache.insert_sql(table_name, tuple(fields), 'numeric')
+        try:
+            last_id = await self.execute(sql, *values)
+            return last_id
+        except Exception as e:
+            if ignore_duplicated and is_duplicate(e):
+                # just skip duplicated item error
+                return 0
+            else:
+                traceback.print_exc()
+                print('sql:', sql)
+                print('item:')
+                for i in range(len(fields)):
+                    vs = str(values[i])
+                    if len(vs) > 300:
+                        print(fields[i], ' : ', len(vs), type(values[i]))
+                    else:
+                        print(fields[i], ' : ', vs, type(values[i]))
+                raise e
+
+    async def table_insert_many(self, table_name, items, fields=None,
+                                max_rows=1000):
+        ''' items: list or iterable of item, written by array DML
+        (executemany() with batcherrors) in chunks of at most max_rows rows,
+        committed chunk by chunk, as ConnectionOracle.table_insert_many().
+        Returns a list of inserted row counts, one for each chunk.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        sql = cache.insert_sql(table_name, tuple(fields), 'numeric')
+        counts = []
+        async with self._cursor_ctx() as cursor:
+            for chunk in bulk.chunks(rows, max_rows):
+                with self._event('executemany', sql) as ev:
+                    await cursor.executemany(sql, chunk, batcherrors=True)
+                    ev.rows = cursor.rowcount
+                errors = [e for e in cursor.getbatcherrors()
+                          if e.code != ORA_DUPLICATE]
+                if errors:
+                    await cursor.connection.rollback()
+                    for error in errors[:10]:
+                        print('\trow', error.offset, ':', error.message)
+                    print('sql:', sql)
+                    raise oracledb.DatabaseError(errors[0])
+                if self._autocommit:
+                    await cursor.connection.commit()
+                counts.append(cursor.rowcount)
+        return counts
+
+    async def table_update(self, table_name, updates,
+                           field_where, value_where):
+        '''updates is a dict of {field_update:value_update}'''
+        sql = cache.update_sql(table_name, tuple(updates), field_where,
+                               'numeric')
+        await self.execute(sql, *updates.values(), value_where)
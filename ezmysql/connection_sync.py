@@ -2,11 +2,50 @@
 Only for python 3
 """
 
+import contextlib
+import os
+import threading
 import time
 import traceback
 import pymysql
 import pymysql.cursors
 
+from . import bulk
+from . import cache
+from . import columns
+from . import membership
+from .errors import is_connection_error
+from .instrument import NO_EVENT
+from .pool import SyncPool
+from .row import Row, row_index
+from .transaction import GroupCommit, Pinned
+
+
+class RowCursorMixin:
+    """Makes rows of the cursor compact Row objects"""
+    def _do_get_result(self):
+        super()._do_get_result()
+        self._index = None
+        if self.description:
+            fields = self._result.fields
+            self._index = row_index([f.name for f in fields],
+                                    [f.table_name for f in fields])
+        if self._index and self._rows:
+            self._rows = [self._conv_row(r) for r in self._rows]
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        return Row(super()._conv_row(row), self._index)
+
+
+class RowCursor(RowCursorMixin, pymysql.cursors.Cursor):
+    """A cursor which returns results as Row"""
+
+
+class SSRowCursor(RowCursorMixin, pymysql.cursors.SSCursor):
+    """An unbuffered cursor which returns results as Row"""
+
 
 class ConnectionSync:
     def __init__(self, host, database, user, password,
@@ -15,7 +54,30 @@ class ConnectionSync:
                  connect_timeout=10,
                  autocommit=True,
                  return_dict=True,
-                 charset="utf8mb4"):
+                 compact_rows=False,
+                 charset="utf8mb4",
+                 pool_size=0,
+                 max_overflow=0,
+                 pool_timeout=30,
+                 result_cache=None,
+                 local_infile=False,
+                 instrument=None):
+        '''
+        compact_rows: return rows as row.Row, a tuple with a shared column
+                      index, which reads like a dict but costs less memory
+        pool_size: > 0 to check a connection out of a thread-safe pool
+                   per call instead of sharing one connection, with
+                   autocommit off each call is committed (rolled back if
+                   it fails) before its connection goes back, use
+                   transaction() for more than one call
+        max_overflow: connections opened beyond pool_size under load,
+                      they are closed when given back
+        pool_timeout: seconds to wait for a free pooled connection
+        result_cache: a cache.ResultCache to cache results of query() and
+                      get(), invalidated by writes through this object
+        local_infile: allow LOAD DATA LOCAL INFILE, needed by table_load()
+        instrument: an instrument.Instrumentation to time every statement
+        '''
         self.max_idle_time = max_idle_time
         self._db_args = {
             'host': host,
@@ -26,13 +88,35 @@ class ConnectionSync:
             'autocommit': autocommit,
             'connect_timeout': connect_timeout,
         }
+        # unbuffered cursor for query_iter()
+        self._ss_cursorclass = pymysql.cursors.SSCursor
         if return_dict:
             self._db_args['cursorclass'] = pymysql.cursors.DictCursor
+            self._ss_cursorclass = pymysql.cursors.SSDictCursor
+        if compact_rows:
+            self._db_args['cursorclass'] = RowCursor
+            self._ss_cursorclass = SSRowCursor
         if port:
             self._db_args['port'] = port
+        if local_infile:
+            self._db_args['local_infile'] = True
         self._db = None
+        self._pool = None
+        self._max_packet = None
+        self.result_cache = result_cache
+        self.instrument = instrument
+        self._local = threading.local()
         self._last_use_time = time.time()
-        self.reconnect()
+        if pool_size > 0:
+            self._pool = SyncPool(
+                self._connect,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                max_idle_time=max_idle_time,
+                timeout=pool_timeout,
+                on_close=self._commit_on_close)
+        else:
+            self.reconnect()
 
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
@@ -49,108 +133,404 @@ class ConnectionSync:
         self._ensure_connected()
         return self._db.cursor()
 
+    @contextlib.contextmanager
+    def _connection(self):
+        """Yields the shared connection, or checks one out of the pool
+        for the duration of a call when pooling is on, or the connection
+        of the transaction the thread is in."""
+        pinned = self._pinned()
+        if pinned is not None:
+            yield pinned.conn
+            return
+        if self._pool is None:
+            self._ensure_connected()
+            yield self._db
+            return
+        conn = self._pool.acquire()
+        broken = False
+        try:
+            yield conn
+            if not self._db_args['autocommit']:
+                # not to sit in the pool holding locks of its writes
+                conn.commit()
+        except BaseException as e:
+            # lost connection and alike, don't give it to the next caller
+            broken = is_connection_error(e)
+            if not broken and not self._db_args['autocommit']:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self._pool.release(conn, discard=broken)
+
+    @contextlib.contextmanager
+    def _cursor_ctx(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _pinned(self):
+        return getattr(self._local, 'pinned', None)
+
+    def in_transaction(self):
+        """Whether this thread is in a transaction() or group_commit()."""
+        return self._pinned() is not None
+
+    def transaction(self):
+        """Runs the statements of the block in one transaction on one
+        connection, committed when the block ends, rolled back if it
+        raises:
+
+            with db.transaction():
+                db.execute('UPDATE account SET n=n-1 WHERE id=%s', 1)
+                db.execute('UPDATE account SET n=n+1 WHERE id=%s', 2)
+
+        The connection is the thread's for the whole block, with
+        pool_size it is checked out of the pool. A transaction() or
+        group_commit() in the block is part of this one.
+        """
+        return self._pin(None)
+
+    def group_commit(self, max_statements=100, max_delay=0.05):
+        """Like transaction(), but commits every max_statements writes, or
+        when a write comes max_delay seconds after the oldest one not
+        committed, so a high rate of small writes pays for one commit
+        (the server's flush to disk) per group instead of per statement:
+
+            with db.group_commit(max_statements=200, max_delay=0.1):
+                for item in items:
+                    db.table_insert('simple', item)
+
+        The rest is committed when the block ends, if it raises only the
+        writes since the last commit are rolled back.
+        """
+        return self._pin(GroupCommit(max_statements, max_delay))
+
+    @contextlib.contextmanager
+    def _pin(self, group):
+        if self._pinned() is not None:
+            yield self
+            return
+        if self._pool is None:
+            self._ensure_connected()
+            conn = self._db
+        else:
+            conn = self._pool.acquire()
+        pinned = Pinned(conn, group)
+        self._local.pinned = pinned
+        broken = False
+        try:
+            conn.begin()
+            yield self
+            self._commit(pinned)
+        except BaseException as e:
+            broken = is_connection_error(e)
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self._local.pinned = None
+            if self._pool is not None:
+                self._pool.release(conn, discard=broken)
+
+    def _commit(self, pinned):
+        pinned.conn.commit()
+        if self.result_cache is not None:
+            for query in pinned.written:
+                self.result_cache.invalidate_sql(query)
+        pinned.written = []
+
+    def _written(self):
+        """Counts a write of a group_commit(), committing the group when
+        it is due."""
+        pinned = self._pinned()
+        if (pinned is not None and pinned.group is not None and
+                pinned.group.add()):
+            self._commit(pinned)
+            pinned.group.committed()
+            pinned.conn.begin()
+
     def __del__(self):
         self.close()
 
+    def _connect(self):
+        return pymysql.connect(**self._db_args)
+
+    def _commit_on_close(self, conn):
+        if not self._db_args['autocommit']:
+            conn.commit()
+
     def close(self):
         """Closes this database connection."""
         if getattr(self, "_db", None) is not None:
-            if not self._db_args['autocommit']:
-                self._db.commit()
+            self._commit_on_close(self._db)
             self._db.close()
             self._db = None
+        if getattr(self, "_pool", None) is not None:
+            self._pool.close()
 
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
         self.close()
-        self._db = pymysql.connect(**self._db_args)
+        if self._pool is None:
+            self._db = self._connect()
+
+    def query_many(self, queries, parallel=False, return_exceptions=False):
+        """query many SQLs, Returns all result.
 
-    def query_many(self, queries):
-        """query many SQLs, Returns all result."""
+        parallel: run the queries at the same time in threads, each on its
+                  own pooled connection, only works with pool_size > 0
+        return_exceptions: put the exception of a failed query in its place
+                           of the results, instead of an empty list
+        """
         assert isinstance(queries, list)
-        cursor = self._cursor()
+        if parallel and self._pool is not None and len(queries) > 1:
+            return self._query_many_parallel(queries, return_exceptions)
         results = []
-        for query in queries:
-            try:
-                cursor.execute(query)
-                result = cursor.fetchall()
-            except Exception as e:
+        with self._cursor_ctx() as cursor:
+            for query in queries:
+                try:
+                    with self._event('query_many', query) as ev:
+                        cursor.execute(query)
+                        result = cursor.fetchall()
+                        ev.rows = len(result)
+                except Exception as e:
+                    print(e)
+                    result = e if return_exceptions else []
+                results.append(result)
+        return results
+
+    def _query_many_parallel(self, queries, return_exceptions):
+        # not at the top, to keep it out of the import of this module
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(len(queries),
+                      self._pool.pool_size + self._pool.max_overflow)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.query, q) for q in queries]
+        results = []
+        for future in futures:
+            e = future.exception()
+            if e is None:
+                results.append(future.result())
+            else:
                 print(e)
-                result = []
-            results.append(result)
+                results.append(e if return_exceptions else [])
         return results
 
+    def _event(self, method, query, args=None):
+        if self.instrument is None:
+            return NO_EVENT
+        return self.instrument.event(method, query, args)
+
+    def _cache_key(self, method, query, args):
+        if self.result_cache is None:
+            return None
+        if self._pinned() is not None:
+            # a transaction sees its own writes, not for the others
+            return None
+        return self.result_cache.key(method, query, args)
+
+    def _invalidate(self, query):
+        if self.result_cache is not None:
+            self.result_cache.invalidate_sql(query)
+            pinned = self._pinned()
+            if pinned is not None:
+                pinned.written.append(query)
+
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            result = cursor.fetchall()
-            return result
-        finally:
-            cursor.close()
+        args = kwparameters or parameters
+        key = self._cache_key('query', query, args)
+        if key is not None:
+            hit, result = self.result_cache.get(key)
+            if hit:
+                return result[:]
+        with self._cursor_ctx() as cursor:
+            with self._event('query', query, args) as ev:
+                cursor.execute(query, args)
+                result = cursor.fetchall()
+                ev.rows = len(result)
+        if key is not None:
+            self.result_cache.put(key, result)
+            result = result[:]
+        return result
+
+    def query_iter(self, query, *parameters, batch_size=1000, **kwparameters):
+        """Yields rows of the given query one by one, fetching them from a
+        server-side cursor `batch_size` rows at a time, so that a huge
+        result set never sits in memory as a whole.
+
+        The connection is busy until the iteration ends, don't run other
+        queries on a not pooled connection in between.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor(self._ss_cursorclass)
+            args = kwparameters or parameters
+            try:
+                with self._event('query_iter', query, args):
+                    cursor.execute(query, args)
+                while True:
+                    with self._event('fetch', query) as ev:
+                        rows = cursor.fetchmany(batch_size)
+                        ev.rows = len(rows)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
+
+    def query_columns(self, query, *parameters, batch_size=10000,
+                      use_numpy=True, **kwparameters):
+        """Returns {column: values} for the given query, rows are fetched
+        from a server-side cursor `batch_size` at a time into one list per
+        column. With numpy installed and use_numpy, integer, float, decimal
+        and date/time columns are numpy arrays (NULL as NaN or NaT, decimal
+        as float64), other columns stay lists.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            args = kwparameters or parameters
+            try:
+                with self._event('query_columns', query, args) as ev:
+                    cursor.execute(query, args)
+                    collector = columns.ColumnCollector(
+                        cursor.description,
+                        columns.mysql_kinds(cursor.description),
+                        [f.table_name for f in cursor._result.fields])
+                    n = 0
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        n += len(rows)
+                        collector.add(rows)
+                    ev.rows = n
+            finally:
+                cursor.close()
+        return collector.result(use_numpy)
 
     def get(self, query, *parameters, **kwparameters):
         """Returns the (singular) row returned by the given query.
         """
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            return cursor.fetchone()
-        finally:
-            cursor.close()
+        args = kwparameters or parameters
+        key = self._cache_key('get', query, args)
+        if key is not None:
+            hit, result = self.result_cache.get(key)
+            if hit:
+                return result
+        with self._cursor_ctx() as cursor:
+            with self._event('get', query, args) as ev:
+                cursor.execute(query, args)
+                result = cursor.fetchone()
+                ev.rows = 0 if result is None else 1
+        if key is not None:
+            self.result_cache.put(key, result)
+        return result
 
     def execute(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the lastrowid from the query."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, kwparameters or parameters)
-            return cursor.lastrowid
-        except Exception as e:
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                raise e
-        finally:
-            cursor.close()
+        with self._cursor_ctx() as cursor:
+            args = kwparameters or parameters
+            try:
+                with self._event('execute', query, args) as ev:
+                    cursor.execute(query, args)
+                    ev.rows = cursor.rowcount
+                self._written()
+                return cursor.lastrowid
+            except Exception as e:
+                if e.args[0] == 1062:
+                    # just skip duplicated item error
+                    pass
+                else:
+                    traceback.print_exc()
+                    raise e
+            finally:
+                self._invalidate(query)
 
     insert = execute
 
     # =============== high level method for table ===================
 
     def table_has(self, table_name, field, value):
-        sql = 'SELECT {} FROM {} WHERE {}="{}"'.format(
-            field,
-            table_name,
-            field,
-            value)
-        d = self.get(sql)
+        sql = cache.has_sql(table_name, field)
+        d = self.get(sql, value)
         return d
 
+    def table_has_many(self, table_name, field, values, chunk_size=1000,
+                       prefilter=None):
+        '''Returns the set of values the field of the table has (as
+        MySQL returns them), checked by `field IN (...)` queries of
+        chunk_size values.
+
+        prefilter: a filter from membership_filter(), values not in it are
+                   taken as absent without asking MySQL
+        '''
+        values = [v for v in dict.fromkeys(values)
+                  if prefilter is None or v in prefilter]
+        present = set()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i+chunk_size]
+            sql = 'SELECT {0} FROM {1} WHERE {0} IN ({2})'.format(
+                field, table_name, ','.join(['%s'] * len(chunk)))
+            for row in self.query(sql, *chunk):
+                present.add(membership.first_value(row))
+        return present
+
+    def membership_filter(self, table_name, field, bloom=True,
+                          capacity=None, error_rate=0.01, batch_size=10000):
+        '''Returns a membership filter of all values of the field, warmed
+        by streaming the column with query_iter(). Use it as the prefilter
+        of table_has_many() or check `value in f` directly, and f.add()
+        the values inserted afterwards.
+
+        bloom: a BloomFilter with error_rate false positives and capacity
+               default to 1.5 * COUNT(*), else an exact but bigger SetFilter
+        The filter compares values exactly, a case-insensitive collation
+        of MySQL may take 'ABC' and 'abc' as the same, the filter doesn't.
+        '''
+        count = 0
+        if bloom and capacity is None:
+            count = membership.first_value(
+                self.get('SELECT COUNT(*) FROM {}'.format(table_name)))
+        f = membership.make_filter(count, bloom, capacity, error_rate)
+        sql = 'SELECT {} FROM {}'.format(field, table_name)
+        for row in self.query_iter(sql, batch_size=batch_size):
+            f.add(membership.first_value(row))
+        return f
+
+    def _print_item(self, sql, fields, values):
+        print('sql:', sql)
+        print('item:')
+        for i in range(len(fields)):
+            vs = str(values[i])
+            if len(vs) > 300:
+                print(fields[i], ' : ', len(vs), type(values[i]))
+            else:
+                print(fields[i], ' : ', vs, type(values[i]))
+
     def table_insert(self, table_name, item):
-        keys, values = [], []
+        '''item is a dict : key is mysql table field,
+        None values are skipped, list/tuple values are written as (1,2,3)
+        for mva type of manticore search'''
+        fields, values = [], []
         for k, v in item.items():
             if v is None:
                 continue
-            keys.append(k)
-            if isinstance(v, (list, tuple)):
-                # for mva type of manticore search
-                x = ','.join([str(i) for i in v])
-                x = f"({x})"
-                values.append(x)
-            elif isinstance(v, str):
+            if isinstance(v, str):
                 v = v.strip('\\')
-                v = v.replace('%', '%%').replace("'", "\\'")
-                values.append(f"'{v}'")
-            else:
-                values.append(f"{v}")
-        keys_str = ','.join(keys)
-        values_str = ','.join(values)
-        sql = f'INSERT INTO {table_name} ({keys_str}) VALUES ({values_str})'
+            fields.append(k)
+            values.append(v)
+        sql = cache.insert_sql(table_name, tuple(fields))
         try:
-            last_id = self.execute(sql)
+            last_id = self.execute(sql, *values)
             return last_id
         except Exception as e:
             print(e)
@@ -159,27 +539,14 @@ class ConnectionSync:
                 pass
             else:
                 traceback.print_exc()
-                print('sql:', sql)
-                print('item:')
-                for i in range(len(keys)):
-                    vs = str(values[i])
-                    if len(vs) > 300:
-                        print(keys[i], ' : ', len(vs), type(values[i]))
-                    else:
-                        print(keys[i], ' : ', vs, type(values[i]))
+                self._print_item(sql, fields, values)
                 raise e
 
-
     def table_insert0(self, table_name, item):
         '''item is a dict : key is mysql table field'''
-        fields = list(item.keys())
+        fields = tuple(item)
         values = list(item.values())
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
-        print(sql)
-        print(values)
+        sql = cache.insert_sql(table_name, fields)
         try:
             last_id = self.execute(sql, *values)
             return last_id
@@ -190,64 +557,163 @@ class ConnectionSync:
                 pass
             else:
                 traceback.print_exc()
-                print('sql:', sql)
-                print('item:')
-                for i in range(len(fields)):
-                    vs = str(values[i])
-                    if len(vs) > 300:
-                        print(fields[i], ' : ', len(vs), type(values[i]))
-                    else:
-                        print(fields[i], ' : ', vs, type(values[i]))
+                self._print_item(sql, fields, values)
                 raise e
 
-    def table_insert_many(self, table_name, items):
-        ''' items: list of item'''
-        assert isinstance(items, list)
-        item = items[0]
-        fields = list(item.keys())
-        values = [list(item.values()) for item in items]
-        fieldstr = ','.join(fields)
-        valstr = ','.join(['%s'] * len(item))
-        sql = 'INSERT INTO {} ({}) VALUES({})'.format(
-            table_name, fieldstr, valstr)
-        cursor = self._cursor()
-        try:
-            last_id = cursor.executemany(sql, values)
-            return last_id
-        except Exception as e:
-            print('\t', e)
-            if e.args[0] == 1062:
-                # just skip duplicated item error
-                pass
-            else:
-                traceback.print_exc()
-                print('sql:', sql)
-                raise e
+    def table_insert_many(self, table_name, items, fields=None,
+                          max_rows=1000, max_bytes=None):
+        ''' items: list or iterable of item, written by multi-row
+        `INSERT ... VALUES (...),(...)` statements of at most max_rows rows
+        and max_bytes bytes (default to the server's max_allowed_packet).
+        fields: fields to insert, default to the keys of the first item.
+        Returns a list of inserted row counts, one for each statement.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        prefix = bulk.insert_prefix(table_name, fields)
+        return self._execute_many_rows(prefix, rows, max_rows, max_bytes)
+
+    def table_upsert_many(self, table_name, items, update_fields=None,
+                          ignore=False, fields=None,
+                          max_rows=1000, max_bytes=None):
+        '''Writes items in bulk like table_insert_many, but a row
+        duplicated on a unique key doesn't fail its whole statement:
+        with ignore it is skipped (INSERT IGNORE), otherwise its
+        update_fields are updated (INSERT ... ON DUPLICATE KEY UPDATE).
+
+        update_fields: fields to update on duplicated rows, default to all
+                       the fields written
+        Returns a list of affected row counts, one for each statement,
+        MySQL counts an inserted row as 1 and an updated one as 2.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        prefix, suffix = bulk.upsert_statement(
+            table_name, fields, update_fields, ignore)
+        return self._execute_many_rows(
+            prefix, rows, max_rows, max_bytes, suffix,
+            ignore_duplicated=False)
+
+    def table_load(self, table_name, items, fields=None,
+                   max_rows=100000, duplicates=None):
+        '''Loads items (a list or iterable of dict) into the table by
+        `LOAD DATA LOCAL INFILE`, much faster than INSERT for big fills.
+        Every max_rows items are written to a temporary tab-separated file
+        and loaded by one statement, the file is removed afterwards.
+        It needs local_infile=True on the connection and local_infile=ON
+        on the server.
+
+        fields: fields to load, default to the keys of the first item
+        duplicates: None, 'ignore' or 'replace' for rows duplicated on a
+                    unique key, None makes such a row an error
+        Returns a list of {'rows': loaded rows, 'warnings': [(level, code,
+        message), ...]}, one for each chunk.
+        '''
+        fields, rows = bulk.item_rows(items, fields)
+        if not fields:
+            return []
+        sql = bulk.load_data_sql(table_name, fields, duplicates)
+        results = []
+        with self._connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.Cursor)
+            try:
+                for chunk in bulk.chunks(rows, max_rows):
+                    fn = bulk.write_tsv_file(chunk)
+                    try:
+                        with self._event('table_load', sql, (fn,)) as ev:
+                            cursor.execute(sql, (fn,))
+                            loaded = ev.rows = cursor.rowcount
+                    finally:
+                        os.remove(fn)
+                    cursor.execute('SHOW WARNINGS')
+                    results.append({
+                        'rows': loaded,
+                        'warnings': list(cursor.fetchall()),
+                    })
+                    self._written()
+            finally:
+                cursor.close()
+                self._invalidate(sql)
+        return results
+
+    def _max_allowed_packet(self, conn):
+        if self._max_packet is None:
+            cursor = conn.cursor(pymysql.cursors.Cursor)
+            try:
+                cursor.execute('SELECT @@max_allowed_packet')
+                server = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+            # pymysql refuses to send a packet bigger than its own limit
+            client = getattr(conn, 'max_allowed_packet', server)
+            self._max_packet = min(server, client)
+        return self._max_packet
+
+    def _execute_many_rows(self, prefix, rows, max_rows, max_bytes,
+                           suffix='', ignore_duplicated=True):
+        def statements(literal, max_bytes):
+            return bulk.multirow_statements(
+                prefix, rows, literal, max_rows, max_bytes, suffix)
+        return self._execute_statements(
+            statements, max_bytes, prefix, ignore_duplicated)
+
+    def _execute_statements(self, statements, max_bytes, write_sql,
+                            ignore_duplicated=False):
+        '''Executes the (sql, row count) pairs from
+        statements(literal, max_bytes) on one connection, returns the
+        affected row counts. write_sql tells the table written.'''
+        counts = []
+        with self._connection() as conn:
+            if max_bytes is None:
+                max_bytes = self._max_allowed_packet(conn)
+            cursor = conn.cursor()
+            try:
+                for sql, _ in statements(conn.escape, max_bytes):
+                    try:
+                        with self._event('execute_many', sql) as ev:
+                            cursor.execute(sql)
+                            ev.rows = cursor.rowcount
+                        counts.append(cursor.rowcount)
+                        self._written()
+                    except Exception as e:
+                        print('\t', e)
+                        if ignore_duplicated and e.args[0] == 1062:
+                            # just skip duplicated item error
+                            counts.append(0)
+                        else:
+                            traceback.print_exc()
+                            print('sql:', sql[:300])
+                            raise e
+            finally:
+                cursor.close()
+                self._invalidate(write_sql)
+        return counts
+
+    def table_update_many(self, table_name, rows, key_field,
+                          max_rows=1000, max_bytes=None):
+        '''rows: list or iterable of dict, each has key_field and the
+        fields to update of the row whose key_field equals to it.
+        Rows are updated by statements of at most max_rows rows, like
+        `UPDATE t SET f=CASE key WHEN k1 THEN v1 ... ELSE f END
+        WHERE key IN (k1, ...)`, max_bytes defaults to max_allowed_packet.
+        Returns a list of changed row counts, one for each statement.
+        An update clashing on a unique key raises, its statement and the
+        ones after it are not applied.
+        '''
+        def statements(literal, max_bytes):
+            return bulk.update_many_statements(
+                table_name, rows, key_field, literal, max_rows, max_bytes)
+        return self._execute_statements(
+            statements, max_bytes, 'UPDATE ' + table_name,
+            ignore_duplicated=False)
 
     def table_update(self, table_name, updates,
                      field_where, value_where):
-        '''updates is a dict of {field_update:value_update}'''
-        upsets = []
-        values = []
-        for k, v in updates.items():
-            if k == 'mva':
-                s = f'{k}={v}'
-                if s.endswith(',)'):
-                    s = s.replace(',)', ')')
-            elif isinstance(v, str):
-                s = f"{k}='{v}'"
-            else:
-                s = f"{k}={v}"
-            upsets.append(s)
-        upsets = ','.join(upsets)
-        if isinstance(value_where, str):
-            sql = "UPDATE {} SET {} WHERE {}='{}'"
-        else:
-            sql = "UPDATE {} SET {} WHERE {}={}"
-        sql = sql.format(
-            table_name,
-            upsets,
-            field_where, value_where,
-        )
-        print(sql)
-        self.execute(sql)
+        '''updates is a dict of {field_update:value_update},
+        list/tuple values are written as (1,2,3) for mva type'''
+        sql = cache.update_sql(table_name, tuple(updates), field_where)
+        values = list(updates.values())
+        values.append(value_where)
+        self.execute(sql, *values)
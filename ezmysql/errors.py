@@ -0,0 +1,27 @@
+"""Errors of the connection itself rather than of the statement
+Only for python 3
+"""
+
+import pymysql
+
+# OperationalError is raised for statement errors too (unknown column,
+# lock wait timeout, ...), only these codes of it are the connection's
+CONNECTION_ERRNOS = frozenset((
+    1040,  # too many connections
+    1053,  # server shutdown in progress
+    2002,  # can't connect through the socket
+    2003,  # can't connect to the server
+    2006,  # server has gone away
+    2012,  # error in the handshake
+    2013,  # lost connection during the query
+    2055,  # lost connection, system error
+))
+CONNECTION_ERRORS = (pymysql.err.InterfaceError, ConnectionError, OSError)
+
+
+def is_connection_error(e):
+    '''Whether e says the connection is lost or unusable, so that it
+    shouldn't be used again and the statement may succeed on another.'''
+    if isinstance(e, pymysql.err.OperationalError):
+        return bool(e.args) and e.args[0] in CONNECTION_ERRNOS
+    return isinstance(e, CONNECTION_ERRORS)
@@ -1,5 +1,7 @@
 # coding:utf-8
 
+import os
+
 
 class IDLog:
     '''save & read int ID to/from a file
@@ -8,10 +10,15 @@ class IDLog:
         self._fn = filename
 
     def save_id(self, _id):
-        f = open(self._fn, 'w')
+        # write to a temp file and rename it, so that a crash in the middle
+        # never leaves a truncated ID behind
+        tmp = self._fn + '.tmp'
+        f = open(tmp, 'w')
         f.write(str(_id))
         f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.replace(tmp, self._fn)
 
     def get_id(self,):
         _id = 0
@@ -23,10 +30,14 @@ class IDLog:
         return _id
 
 
-def get_data(db, table, from_id, limit, fields=None):
+def get_data(db, table, from_id, limit, fields=None, to_id=None):
+    '''rows of from_id < id [<= to_id], ordered by id'''
     selected = '*'
     if fields:
         selected = ','.join(fields)
-    sql = 'select {} from {} where id > {} order by id limit {}'
+    sql = 'select {} from {} where id > {}'
+    if to_id is not None:
+        sql += ' and id <= {}'.format(to_id)
+    sql += ' order by id limit {}'
     sql = sql.format(selected, table, from_id, limit)
     return db.query(sql)
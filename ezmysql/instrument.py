@@ -0,0 +1,213 @@
+"""Timing of statements: hooks, latency histograms and slow query log
+Only for python 3
+"""
+
+import bisect
+import logging
+import re
+import threading
+import time
+
+from .cache import LRUCache
+
+slow_logger = logging.getLogger('ezmysql.slow')
+
+_RE_COMMENT = re.compile(r'/\*.*?\*/|--[^\n]*|#[^\n]*', re.S)
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"",
+                        re.S)
+_RE_NUMBER = re.compile(r'(?<![\w.`])[-+]?(?:0x[0-9a-f]+|\d+(?:\.\d+)?'
+                        r'(?:e[-+]?\d+)?)\b', re.I)
+_RE_PARAM = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+_RE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_RE_SPACE = re.compile(r'\s+')
+
+_fingerprints = LRUCache(maxsize=4096)
+
+
+def fingerprint(sql):
+    '''Normalizes a SQL to its shape: literals and placeholders become ?,
+    lists of them (...), so that `id in (1,2,3)` and `id in (%s)` share
+    one fingerprint.'''
+    fp = _fingerprints.get(sql)
+    if fp is not None:
+        return fp
+    fp = _RE_STRING.sub('?', sql)
+    fp = _RE_COMMENT.sub(' ', fp)
+    fp = _RE_NUMBER.sub('?', fp)
+    fp = _RE_PARAM.sub('?', fp)
+    fp = _RE_LIST.sub('(...)', fp)
+    fp = _RE_ROWS.sub('(...)', fp)
+    fp = _RE_SPACE.sub(' ', fp).strip().lower()
+    if len(sql) <= 2048:
+        _fingerprints.put(sql, fp)
+    return fp
+
+
+class Histogram:
+    '''Counts of latencies in seconds by exponential buckets, from 0.1ms
+    to 10s.'''
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        '''upper bound of the bucket holding the q (0~1) quantile'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+class QueryEvent:
+    '''One statement measured by Instrumentation, passed to the hooks.
+    Used as a context manager around execute and fetch, the code inside
+    sets `rows`.'''
+    __slots__ = ('_instrument', 'method', 'sql', 'params_count', 'sql_bytes',
+                 'rows', 'start', 'elapsed', 'error')
+
+    def __init__(self, instrument, method, sql, params):
+        self._instrument = instrument
+        self.method = method
+        self.sql = sql
+        self.params_count = len(params) if params else 0
+        self.sql_bytes = len(sql.encode('utf8') if isinstance(sql, str)
+                             else sql)
+        self.rows = None
+        self.start = 0.0
+        self.elapsed = 0.0
+        self.error = None
+
+    @property
+    def fingerprint(self):
+        return fingerprint(self.sql)
+
+    def __enter__(self):
+        for hook in self._instrument.before_hooks:
+            hook(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start
+        self.error = exc
+        self._instrument.finish(self)
+        return False
+
+
+class _NoEvent:
+    '''Stands for QueryEvent when a connection is not instrumented.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NO_EVENT = _NoEvent()
+
+
+class Instrumentation:
+    '''Measures every statement run by a connection holding it:
+
+        ins = Instrumentation(slow_query_time=0.5)
+        db = ConnectionSync(host, database, user, password, instrument=ins)
+        ...
+        for fp, summary in ins.stats()[:10]:
+            print(fp, summary)
+
+    before_hooks and after_hooks are lists of functions called with the
+    QueryEvent before executing and after fetching. A latency Histogram
+    is kept per SQL fingerprint, the time waiting for a connection of an
+    async pool in pool_wait. Statements slower than slow_query_time
+    seconds are logged to the `ezmysql.slow` logger, or passed to
+    slow_query_log(event) if given.
+    '''
+    def __init__(self, slow_query_time=1.0, slow_query_log=None,
+                 histograms=True):
+        self.slow_query_time = slow_query_time
+        self.slow_query_log = slow_query_log
+        self.keep_histograms = histograms
+        self.before_hooks = []
+        self.after_hooks = []
+        self.histograms = {}
+        self.pool_wait = Histogram()
+        self._lock = threading.Lock()
+
+    def add_before_hook(self, hook):
+        self.before_hooks.append(hook)
+
+    def add_after_hook(self, hook):
+        self.after_hooks.append(hook)
+
+    def event(self, method, sql, params=None):
+        return QueryEvent(self, method, sql, params)
+
+    def finish(self, event):
+        if self.keep_histograms:
+            fp = event.fingerprint
+            with self._lock:
+                histogram = self.histograms.get(fp)
+                if histogram is None:
+                    histogram = self.histograms[fp] = Histogram()
+                histogram.add(event.elapsed)
+        if (self.slow_query_time is not None and
+                event.elapsed >= self.slow_query_time):
+            if self.slow_query_log is not None:
+                self.slow_query_log(event)
+            else:
+                slow_logger.warning(
+                    '%.3fs %s rows=%s params=%s: %s', event.elapsed,
+                    event.method, event.rows, event.params_count,
+                    event.sql[:1000])
+        for hook in self.after_hooks:
+            hook(event)
+
+    def record_pool_wait(self, seconds):
+        with self._lock:
+            self.pool_wait.add(seconds)
+
+    def stats(self):
+        '''Returns [(fingerprint, summary dict)] by total time, hottest
+        first.'''
+        with self._lock:
+            items = [(fp, h.summary()) for fp, h in self.histograms.items()]
+        items.sort(key=lambda x: x[1]['total'], reverse=True)
+        return items
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.pool_wait = Histogram()
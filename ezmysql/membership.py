@@ -0,0 +1,110 @@
+"""In-process membership filters to answer "is it in the table?" without
+asking MySQL, mostly for the negatives
+Only for python 3
+"""
+
+import hashlib
+import math
+from collections.abc import Mapping
+from decimal import Decimal
+
+
+def _number(value):
+    # 3, 3.0 and Decimal('3.00') read the same, as MySQL compares them
+    # equal, and 0.1 as Decimal('0.10')
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        # repr() is the shortest form reading back as the same float
+        value = Decimal(repr(value))
+    if not value.is_finite():
+        return str(value)
+    if value == value.to_integral_value():
+        return str(int(value))
+    return format(value.normalize(), 'f')
+
+
+def _key(value):
+    # 3 and '3' are the same key, as MySQL compares them equal
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf8')
+    if isinstance(value, (int, float, Decimal)):
+        return _number(value).encode('utf8')
+    return str(value).encode('utf8')
+
+
+def first_value(row):
+    '''value of the first column of a row in any row type'''
+    if isinstance(row, Mapping):
+        return next(iter(row.values()))
+    return row[0]
+
+
+def make_filter(count, bloom=True, capacity=None, error_rate=0.01):
+    '''A BloomFilter for a column of count values, or a SetFilter if not
+    bloom. capacity defaults to 1.5 * count to leave room for values
+    added later.'''
+    if not bloom:
+        return SetFilter()
+    if capacity is None:
+        capacity = int(count * 1.5) + 1000
+    return BloomFilter(capacity, error_rate)
+
+
+class BloomFilter:
+    '''A Bloom filter of about `capacity` values, `value in f` is False for
+    sure when the value was never added, and True for a value not added
+    with a probability of error_rate.'''
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(_key(value), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        m = self.num_bits
+        return [(h1 + i * h2) % m for i in range(self.num_hashes)]
+
+    def add(self, value):
+        bits = self._bits
+        for p in self._positions(value):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self._bits
+        for p in self._positions(value):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+class SetFilter:
+    '''An exact filter backed by a set, costs more memory than BloomFilter
+    but never answers True for a value not added.'''
+    def __init__(self):
+        self._keys = set()
+
+    def add(self, value):
+        self._keys.add(_key(value))
+
+    def __contains__(self, value):
+        return _key(value) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,121 @@
+"""A small thread-safe pool of DB-API connections
+Only for python 3
+"""
+
+import queue
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class SyncPool:
+    '''Keeps up to `pool_size` idle connections and opens at most
+    `max_overflow` extra ones under load.
+
+    connect: a callable returns a new DB-API connection
+    max_idle_time: idle connections older than it are reopened on checkout
+    timeout: seconds to wait for a free connection, None waits forever
+    '''
+    def __init__(self, connect,
+                 pool_size=5,
+                 max_overflow=0,
+                 max_idle_time=7*3600,
+                 timeout=30,
+                 on_close=None):
+        self._connect = connect
+        self._on_close = on_close
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.max_idle_time = max_idle_time
+        self.timeout = timeout
+        # LIFO keeps the hot connections hot and lets the cold ones idle out
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    @property
+    def size(self):
+        return self._opened
+
+    def _open(self):
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def _close(self, conn):
+        with self._lock:
+            self._opened -= 1
+        try:
+            if self._on_close is not None:
+                self._on_close(conn)
+            conn.close()
+        except Exception:
+            pass
+
+    def _fresh(self, conn, last_use_time):
+        if time.time() - last_use_time > self.max_idle_time:
+            # Mysql closes client connections that are idle for too
+            # long, drop it before the caller finds out the hard way.
+            self._close(conn)
+            return None
+        return conn
+
+    def acquire(self):
+        '''Checks a connection out, reopening it if it has been idle
+        for longer than max_idle_time.'''
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        wait = 0
+        while True:
+            try:
+                if wait:
+                    entry = self._idle.get(timeout=wait)
+                else:
+                    entry = self._idle.get_nowait()
+            except queue.Empty:
+                entry = None
+            if entry is not None:
+                conn = self._fresh(*entry)
+                if conn is not None:
+                    return conn
+                wait = 0
+                continue
+            with self._lock:
+                can_open = self._opened < self.pool_size + self.max_overflow
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                return self._open()
+            # all connections are checked out, wait a moment for one to
+            # come back or to be discarded so that we can open a new one
+            wait = 0.05
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise PoolTimeout(
+                        'no free connection in {} seconds, opened: {}'.format(
+                            self.timeout, self._opened))
+
+    def release(self, conn, discard=False):
+        '''Returns a connection to the pool, closes it if it is broken
+        or it was opened as an overflow one.'''
+        if discard or self._opened > self.pool_size:
+            self._close(conn)
+            return
+        self._idle.put((conn, time.time()))
+
+    def close(self):
+        '''Closes all idle connections, the pool is still usable.'''
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
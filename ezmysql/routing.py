@@ -0,0 +1,344 @@
+"""Read/write splitting: reads go to replicas picked by observed latency
+and in-flight count, writes to the primary
+Only for python 3
+"""
+
+import contextvars
+import random
+import threading
+import time
+
+from .errors import is_connection_error
+
+# errors of a replica itself rather than of the statement count against
+# its health and the read is retried on the primary
+is_replica_error = is_connection_error
+
+
+class Replica:
+    '''A replica connection with its health and load:
+
+    latency: EWMA of the seconds of a read, None before the first one
+    last_read: time.time() of the last read measured
+    inflight: reads running on it now
+    failures: consecutive failed reads, evicted_until is set after
+              max_failures of them
+    '''
+    __slots__ = ('conn', 'latency', 'last_read', 'inflight', 'failures',
+                 'evicted_until', 'reads')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.latency = None
+        self.last_read = 0.0
+        self.inflight = 0
+        self.failures = 0
+        self.evicted_until = 0.0
+        self.reads = 0
+
+    def score(self, now, decay_time):
+        # expected wait of a new read: the latency times the reads ahead,
+        # an unmeasured replica goes first to get measured
+        if self.latency is None:
+            return 0.0
+        latency = self.latency
+        if decay_time:
+            # a latency not measured for a while halves every decay_time
+            # seconds, so that a replica once slow gets tried again
+            latency *= 0.5 ** ((now - self.last_read) / decay_time)
+        return latency * (self.inflight + 1)
+
+
+class ReplicaSet:
+    '''Picks the replica for a read and keeps their health.
+
+    alpha: weight of the latest latency in the EWMA
+    max_failures: consecutive failures evicting a replica
+    eviction_time: seconds an evicted replica is left out, after which it
+                   gets one read to prove it is back
+    decay_time: half-life in seconds of a latency no longer measured
+    '''
+    def __init__(self, conns, alpha=0.2, max_failures=3, eviction_time=30,
+                 decay_time=10):
+        self.replicas = [Replica(c) for c in conns]
+        self.alpha = alpha
+        self.decay_time = decay_time
+        self.max_failures = max_failures
+        self.eviction_time = eviction_time
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Returns the Replica for a read and counts it in flight,
+        None if all of them are evicted.'''
+        now = time.time()
+        best = None
+        best_score = 0.0
+        with self._lock:
+            candidates = list(self.replicas)
+            # equal scores shouldn't always land on the first one
+            random.shuffle(candidates)
+            for r in candidates:
+                if r.evicted_until > now:
+                    continue
+                score = r.score(now, self.decay_time)
+                if best is None or score < best_score:
+                    best = r
+                    best_score = score
+            if best is not None:
+                if best.evicted_until:
+                    # a probe after the eviction: one more failure
+                    # evicts it again
+                    best.evicted_until = 0.0
+                    best.failures = self.max_failures - 1
+                best.inflight += 1
+        return best
+
+    def release(self, replica, elapsed, failed=False):
+        with self._lock:
+            replica.inflight -= 1
+            replica.reads += 1
+            if failed:
+                replica.failures += 1
+                if replica.failures >= self.max_failures:
+                    replica.evicted_until = time.time() + self.eviction_time
+                return
+            replica.failures = 0
+            replica.last_read = time.time()
+            if replica.latency is None:
+                replica.latency = elapsed
+            else:
+                replica.latency += self.alpha * (elapsed - replica.latency)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [{
+                'latency': r.latency,
+                'inflight': r.inflight,
+                'reads': r.reads,
+                'failures': r.failures,
+                'evicted': r.evicted_until > now,
+            } for r in self.replicas]
+
+
+class _RoutedBase:
+    '''Methods shared by the sync and async routed connections, anything
+    not defined here is the primary's.'''
+    def __init__(self, primary, replicas, read_your_writes=0,
+                 max_failures=3, eviction_time=30):
+        self.primary = primary
+        self.replicas = ReplicaSet(replicas, max_failures=max_failures,
+                                   eviction_time=eviction_time)
+        self.read_your_writes = read_your_writes
+
+    def __getattr__(self, name):
+        if name == 'primary':
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def _sticky(self):
+        if self.primary.in_transaction():
+            # a transaction on the primary reads what it wrote
+            return True
+        if not self.read_your_writes:
+            return False
+        return time.time() - self._last_write_time() < self.read_your_writes
+
+    def stats(self):
+        return self.replicas.stats()
+
+
+class RoutedConnectionSync(_RoutedBase):
+    '''Sends query(), get(), table_has(), table_has_many() and
+    query_columns() to the replica expected to answer first, by the EWMA of
+    its latency and its reads in flight, and everything else to the
+    primary:
+
+        db = RoutedConnectionSync(
+            ConnectionSync(primary_host, database, user, password),
+            [ConnectionSync(h, database, user, password, pool_size=4)
+             for h in replica_hosts],
+            read_your_writes=2)
+
+    A replica failing with a connection error max_failures times in a row
+    is left out for eviction_time seconds, the failed read is retried on
+    the primary, as are all reads when no replica is left.
+
+    read_your_writes: for that many seconds after a write in a thread,
+                      reads of the thread go to the primary too, so they
+                      see the write whatever the replication lag
+    In a primary's transaction() or group_commit(), reads go to it too.
+    Give replicas pool_size to share them between threads.
+    '''
+    def __init__(self, primary, replicas, read_your_writes=0,
+                 max_failures=3, eviction_time=30):
+        super().__init__(primary, replicas, read_your_writes,
+                         max_failures, eviction_time)
+        self._local = threading.local()
+
+    def _last_write_time(self):
+        return getattr(self._local, 'last_write_time', 0.0)
+
+    def _read(self, method, *args, **kwargs):
+        replica = None
+        if not self._sticky():
+            replica = self.replicas.acquire()
+        if replica is None:
+            return getattr(self.primary, method)(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = getattr(replica.conn, method)(*args, **kwargs)
+        except BaseException as e:
+            if not is_replica_error(e):
+                # the statement's fault, not the replica's
+                self.replicas.release(replica, time.perf_counter() - start)
+                raise
+            self.replicas.release(replica, 0, failed=True)
+            return getattr(self.primary, method)(*args, **kwargs)
+        self.replicas.release(replica, time.perf_counter() - start)
+        return result
+
+    def _write(self, method, *args, **kwargs):
+        try:
+            return getattr(self.primary, method)(*args, **kwargs)
+        finally:
+            if self.read_your_writes:
+                self._local.last_write_time = time.time()
+
+    def query(self, query, *parameters, **kwparameters):
+        return self._read('query', query, *parameters, **kwparameters)
+
+    def get(self, query, *parameters, **kwparameters):
+        return self._read('get', query, *parameters, **kwparameters)
+
+    def table_has(self, table_name, field, value):
+        return self._read('table_has', table_name, field, value)
+
+    def table_has_many(self, table_name, field, values, **kwargs):
+        return self._read('table_has_many', table_name, field, values,
+                          **kwargs)
+
+    def query_columns(self, query, *parameters, **kwparameters):
+        return self._read('query_columns', query, *parameters,
+                          **kwparameters)
+
+    def execute(self, query, *parameters, **kwparameters):
+        return self._write('execute', query, *parameters, **kwparameters)
+
+    insert = execute
+
+    def table_insert(self, table_name, item, *args, **kwargs):
+        return self._write('table_insert', table_name, item, *args, **kwargs)
+
+    def table_insert_many(self, table_name, items, **kwargs):
+        return self._write('table_insert_many', table_name, items, **kwargs)
+
+    def table_upsert_many(self, table_name, items, **kwargs):
+        return self._write('table_upsert_many', table_name, items, **kwargs)
+
+    def table_load(self, table_name, items, **kwargs):
+        return self._write('table_load', table_name, items, **kwargs)
+
+    def table_update(self, table_name, updates, field_where, value_where):
+        return self._write('table_update', table_name, updates,
+                           field_where, value_where)
+
+    def table_update_many(self, table_name, rows, key_field, **kwargs):
+        return self._write('table_update_many', table_name, rows,
+                           key_field, **kwargs)
+
+    def close(self):
+        self.primary.close()
+        for r in self.replicas.replicas:
+            r.conn.close()
+
+
+class RoutedConnectionAsync(_RoutedBase):
+    '''RoutedConnectionSync for ConnectionAsync primary and replicas,
+    read_your_writes sticks to the asyncio task (the context) writing.'''
+    def __init__(self, primary, replicas, read_your_writes=0,
+                 max_failures=3, eviction_time=30):
+        super().__init__(primary, replicas, read_your_writes,
+                         max_failures, eviction_time)
+        self._write_time = contextvars.ContextVar(
+            'ezmysql_last_write_time', default=0.0)
+
+    def _last_write_time(self):
+        return self._write_time.get()
+
+    async def _read(self, method, *args, **kwargs):
+        replica = None
+        if not self._sticky():
+            replica = self.replicas.acquire()
+        if replica is None:
+            return await getattr(self.primary, method)(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = await getattr(replica.conn, method)(*args, **kwargs)
+        except BaseException as e:
+            if not is_replica_error(e):
+                self.replicas.release(replica, time.perf_counter() - start)
+                raise
+            self.replicas.release(replica, 0, failed=True)
+            return await getattr(self.primary, method)(*args, **kwargs)
+        self.replicas.release(replica, time.perf_counter() - start)
+        return result
+
+    async def _write(self, method, *args, **kwargs):
+        try:
+            return await getattr(self.primary, method)(*args, **kwargs)
+        finally:
+            if self.read_your_writes:
+                self._write_time.set(time.time())
+
+    async def query(self, query, *parameters, **kwparameters):
+        return await self._read('query', query, *parameters, **kwparameters)
+
+    async def get(self, query, *parameters, **kwparameters):
+        return await self._read('get', query, *parameters, **kwparameters)
+
+    async def table_has(self, table_name, field, value):
+        return await self._read('table_has', table_name, field, value)
+
+    async def table_has_many(self, table_name, field, values, **kwargs):
+        return await self._read('table_has_many', table_name, field, values,
+                                **kwargs)
+
+    async def query_columns(self, query, *parameters, **kwparameters):
+        return await self._read('query_columns', query, *parameters,
+                                **kwparameters)
+
+    async def execute(self, query, *parameters, **kwparameters):
+        return await self._write('execute', query, *parameters,
+                                 **kwparameters)
+
+    insert = execute
+
+    async def table_insert(self, table_name, item, *args, **kwargs):
+        return await self._write('table_insert', table_name, item,
+                                 *args, **kwargs)
+
+    async def table_insert_many(self, table_name, items, **kwargs):
+        return await self._write('table_insert_many', table_name, items,
+                                 **kwargs)
+
+    async def table_upsert_many(self, table_name, items, **kwargs):
+        return await self._write('table_upsert_many', table_name, items,
+                                 **kwargs)
+
+    async def table_load(self, table_name, items, **kwargs):
+        return await self._write('table_load', table_name, items, **kwargs)
+
+    async def table_update(self, table_name, updates, field_where,
+                           value_where):
+        return await self._write('table_update', table_name, updates,
+                                 field_where, value_where)
+
+    async def table_update_many(self, table_name, rows, key_field, **kwargs):
+        return await self._write('table_update_many', table_name, rows,
+                                 key_field, **kwargs)
+
+    def close(self):
+        self.primary.close()
+        for r in self.replicas.replicas:
+            r.conn.close()
@@ -0,0 +1,80 @@
+"""Compact rows: a tuple of values plus a column index shared by all rows
+of a result set
+Only for python 3
+"""
+
+from collections.abc import Mapping
+
+
+def row_index(names, tables=None):
+    '''Returns {column name: position} for the column names of a result,
+    a repeated name is prefixed with its table name like pymysql's
+    DictCursor does.'''
+    index = {}
+    for i, name in enumerate(names):
+        if name in index and tables is not None:
+            name = tables[i] + '.' + name
+        index[name] = i
+    return index
+
+
+class Row(Mapping):
+    '''A read-only row behaves like a dict of {column: value}, the values
+    can also be read as attributes or by position:
+
+        row['title'], row.title, row[0]
+
+    It holds only a tuple of values and a reference to the column index,
+    which costs much less memory than a dict per row.
+    '''
+    __slots__ = ('_values', '_index')
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return self._values[self._index[key]]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getstate__(self):
+        return self._values, self._index
+
+    def __setstate__(self, state):
+        self._values, self._index = state
+
+    def __repr__(self):
+        return 'Row({})'.format(', '.join(
+            '{}={!r}'.format(k, self._values[i])
+            for k, i in self._index.items()))
+
+    def values(self):
+        return [self._values[i] for i in self._index.values()]
+
+    def items(self):
+        values = self._values
+        return [(k, values[i]) for k, i in self._index.items()]
+
+    def as_tuple(self):
+        return self._values
+
+    def as_dict(self):
+        return dict(self.items())
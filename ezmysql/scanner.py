@@ -0,0 +1,233 @@
+# coding:utf-8
+"""Parallel and resumable scanning of a table by its `id`
+"""
+
+import asyncio
+import json
+import os
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from .eztool import IDLog, get_data
+
+BOUNDS_SQL = 'SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM {}'
+
+
+def split_range(min_id, max_id, partitions):
+    '''Splits ids of [min_id, max_id] into `partitions` ranges of
+    (lo, hi], the first lo is min_id - 1.'''
+    lo = min_id - 1
+    span = max_id - lo
+    partitions = max(1, min(partitions, span))
+    bounds = [lo + span * i // partitions for i in range(partitions + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _min_max(row):
+    if isinstance(row, Mapping):
+        return row['min_id'], row['max_id']
+    return row[0], row[1]
+
+
+def _row_id(row, fields):
+    if isinstance(row, Mapping):
+        return row['id']
+    return row[fields.index('id') if fields else 0]
+
+
+class _ScanPlan:
+    '''The partitions of a scan and their checkpoints.
+
+    With a checkpoint prefix, the partitions are saved to `{prefix}.plan`
+    so that a resumed scan splits the table the same way, and partition i
+    saves the last id it finished to `{prefix}.{i}` by IDLog.
+    '''
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.ranges = None
+        self.logs = []
+
+    def load(self):
+        if not self.checkpoint:
+            return False
+        fn = self.checkpoint + '.plan'
+        if not os.path.exists(fn):
+            return False
+        with open(fn) as f:
+            self.ranges = [tuple(r) for r in json.load(f)]
+        self._open_logs()
+        return True
+
+    def create(self, min_id, max_id, partitions):
+        self.ranges = split_range(min_id, max_id, partitions)
+        if self.checkpoint:
+            tmp = self.checkpoint + '.plan.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.ranges, f)
+            os.replace(tmp, self.checkpoint + '.plan')
+        self._open_logs()
+
+    def _open_logs(self):
+        if self.checkpoint:
+            self.logs = [IDLog('{}.{}'.format(self.checkpoint, i))
+                         for i in range(len(self.ranges))]
+        else:
+            self.logs = [None] * len(self.ranges)
+
+    def start_id(self, i):
+        lo = self.ranges[i][0]
+        log = self.logs[i]
+        if log is None:
+            return lo
+        return max(lo, log.get_id())
+
+    def save(self, i, last_id):
+        if self.logs[i] is not None:
+            self.logs[i].save_id(last_id)
+
+
+class TableScanner:
+    '''Scans a table by ranges of `id` at the same time in threads,
+    and calls callback(rows) with every batch of rows.
+
+        db = ConnectionSync(..., pool_size=4)
+        scanner = TableScanner(db, 'tbl', handle_rows, partitions=4,
+                               checkpoint='/data/tbl.scan')
+        scanner.run()
+
+    The id range is split by MIN(id) and MAX(id) of the table into
+    `partitions` parts. With `checkpoint`, every part saves its progress
+    after a batch is handled, a crashed scan resumes from there when run
+    again with the same checkpoint, delete the files to start over.
+    Rows must carry the `id` field.
+
+    callback is called from the worker threads, it must be thread-safe.
+    The threads share db, give it a pool_size >= partitions, a not pooled
+    ConnectionSync scans the parts one after another.
+    '''
+    def __init__(self, db, table, callback,
+                 partitions=4,
+                 batch_size=1000,
+                 fields=None,
+                 checkpoint=None):
+        self.db = db
+        self.table = table
+        self.callback = callback
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.fields = fields
+        if fields and 'id' not in fields:
+            self.fields = ['id'] + list(fields)
+        self._plan = _ScanPlan(checkpoint)
+        self._stop = threading.Event()
+
+    def _bounds(self):
+        return _min_max(self.db.get(BOUNDS_SQL.format(self.table)))
+
+    def plan(self):
+        '''Returns the (lo, hi] id ranges of the partitions.'''
+        if self._plan.ranges is None and not self._plan.load():
+            min_id, max_id = self._bounds()
+            if min_id is None:
+                # empty table
+                return []
+            self._plan.create(min_id, max_id, self.partitions)
+        return self._plan.ranges
+
+    def _scan(self, i):
+        hi = self._plan.ranges[i][1]
+        from_id = self._plan.start_id(i)
+        while from_id < hi and not self._stop.is_set():
+            rows = get_data(self.db, self.table, from_id, self.batch_size,
+                            self.fields, hi)
+            if not rows:
+                break
+            self.callback(rows)
+            from_id = _row_id(rows[-1], self.fields)
+            self._plan.save(i, from_id)
+            if len(rows) < self.batch_size:
+                break
+
+    def run(self):
+        '''Scans all partitions, returns when all of them are done.'''
+        ranges = self.plan()
+        if not ranges:
+            return
+        workers = 1
+        if getattr(self.db, '_pool', None) is not None:
+            workers = len(ranges)
+        self._stop.clear()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._scan, i)
+                       for i in range(len(ranges))]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # let the other partitions stop after their current batch
+                self._stop.set()
+                raise
+
+
+class TableScannerAsync:
+    '''TableScanner for ConnectionAsync, the partitions are scanned
+    concurrently on the pool connections, callback(rows) can be a plain
+    function or a coroutine function.
+
+        scanner = TableScannerAsync(db, 'tbl', handle_rows, partitions=4,
+                                    checkpoint='/data/tbl.scan')
+        await scanner.run()
+    '''
+    def __init__(self, db, table, callback,
+                 partitions=4,
+                 batch_size=1000,
+                 fields=None,
+                 checkpoint=None):
+        self.db = db
+        self.table = table
+        self.callback = callback
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.fields = fields
+        if fields and 'id' not in fields:
+            self.fields = ['id'] + list(fields)
+        self._plan = _ScanPlan(checkpoint)
+
+    async def plan(self):
+        '''Returns the (lo, hi] id ranges of the partitions.'''
+        if self._plan.ranges is None and not self._plan.load():
+            row = await self.db.get(BOUNDS_SQL.format(self.table))
+            min_id, max_id = _min_max(row)
+            if min_id is None:
+                return []
+            self._plan.create(min_id, max_id, self.partitions)
+        return self._plan.ranges
+
+    async def _scan(self, i):
+        hi = self._plan.ranges[i][1]
+        from_id = self._plan.start_id(i)
+        while from_id < hi:
+            rows = await get_data(self.db, self.table, from_id,
+                                  self.batch_size, self.fields, hi)
+            if not rows:
+                break
+            ret = self.callback(rows)
+            if asyncio.iscoroutine(ret):
+                await ret
+            from_id = _row_id(rows[-1], self.fields)
+            self._plan.save(i, from_id)
+            if len(rows) < self.batch_size:
+                break
+
+    async def run(self):
+        '''Scans all partitions, returns when all of them are done.'''
+        ranges = await self.plan()
+        tasks = [asyncio.ensure_future(self._scan(i))
+                 for i in range(len(ranges))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
@@ -0,0 +1,59 @@
+"""State of transaction() and group_commit() of the connection classes
+Only for python 3
+"""
+
+import time
+
+
+class GroupCommit:
+    '''Decides when the writes of a group_commit() are committed: after
+    max_statements writes, or at the first write coming when the oldest
+    uncommitted one is max_delay seconds old. What is left is committed
+    when the group_commit() block ends.
+    '''
+    def __init__(self, max_statements=100, max_delay=0.05):
+        self.max_statements = max_statements
+        self.max_delay = max_delay
+        self.pending = 0
+        self.commits = 0
+        self._first_time = 0.0
+
+    def add(self):
+        '''Counts a write, returns True if it is time to commit.'''
+        now = time.monotonic()
+        if not self.pending:
+            self._first_time = now
+        self.pending += 1
+        if self.pending >= self.max_statements:
+            return True
+        return (self.max_delay is not None and
+                now - self._first_time >= self.max_delay)
+
+    def committed(self):
+        self.pending = 0
+        self.commits += 1
+
+
+class Pinned:
+    '''The connection a transaction runs on, with what it wrote.
+
+    group: a GroupCommit in group_commit(), None in transaction()
+    lock: an asyncio.Lock for the tasks sharing it in async mode
+    reading: a query_iter() or stream() is reading a result on it
+    readers: the async generators of query_iter() and stream() started
+             in the transaction, closed before it ends
+    written: SQLs written, their cached results are dropped again at
+             commit, as others may have cached the old rows meanwhile
+    closed: the transaction has ended, tasks started in it and still
+            running go back to the pool
+    '''
+    __slots__ = ('conn', 'group', 'lock', 'reading', 'readers', 'written', 'closed')
+
+    def __init__(self, conn, group=None, lock=None):
+        self.conn = conn
+        self.group = group
+        self.lock = lock
+        self.reading = False
+        self.readers = []
+        self.written = []
+        self.closed = False
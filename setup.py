@@ -24,5 +24,8 @@ setup(
         'aiomysql',
         'pymysql',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     license='BSD',
 )